@@ -35,7 +35,6 @@
                 requests
                 pillow
                 feedgen
-                markdown
                 importlib-metadata ])
             ++ [ (pkgs.callPackage hypy_utils {}) ];
             preInstall = ''
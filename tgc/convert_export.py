@@ -2,14 +2,16 @@ import argparse
 import json
 import os.path
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from subprocess import check_call, CalledProcessError
+from typing import Iterator, Iterable
 
 from hypy_utils import printc, write, json_stringify
 from hypy_utils.dict_utils import remove_nones
 
-from .convert_media_types import tgs_to_apng, extract_album_art
-from .pyro.consts import HTML
+from .convert_media_types import tgs_to_apng, extract_album_art, tgs_to_apng_batch, LOTTIE_BATCH_SIZE
+from .output import write_posts, change_summary
 
 test_text = [
     "test ",
@@ -105,141 +107,10 @@ def plain_text(text: str | list[dict | str] | None) -> str | None:
     return acc
 
 
-def process_file_path(path: str | None) -> str | None:
-    """
-    Ensure file paths are url-safe
-    """
-    if path is None:
-        return None
-
-    # Convert tgs stickers to apng
-    if path.endswith(".tgs"):
-        path = str(tgs_to_apng(p / path).relative_to(p))
-
-    return path
-
-
-def parse_file(d: dict) -> dict | None:
-    file = d.get("file")
-    if file is None:
-        return None
-
-    # Create file
-    file = {
-        "url": process_file_path(file),
-        "thumb": process_file_path(d.get("thumbnail")),
-        "mime_type": d.get("mime_type"),
-        "size": os.path.getsize(p / file),
-        "original_name": d.get("original_name"),
-
-        # Media
-        "media_type": d.get("media_type"),
-
-        # Video/audio/gif
-        "duration": d.get("duration_seconds"),
-
-        # Video/sticker/gif
-        "width": d.get("width"),
-        "height": d.get("height"),
-
-        # Sticker
-        "sticker_emoji": d.get("sticker_emoji"),
-
-        # Audio
-        "title": d.get("title"),
-        "performer": d.get("performer")
-    }
-
-    # Convert image file to photo
-    if not file['media_type'] and file['mime_type'].startswith('image'):
-        file['media_type'] = "photo"
-
-    # Add image for missing album cover art
-    if file['media_type'] == 'audio_file' and not file['thumb']:
-        fp = p / file['url']
-        op = extract_album_art(fp)
-        if op:
-            file['thumb'] = op.relative_to(p)
-
-    return file
-
-
 def get_image(d: dict) -> dict:
     return {"url": d.get("photo"), "width": d.get("width"), "height": d.get("height")}
 
 
-def convert_msg(d: dict) -> dict | None:
-    """
-    Convert a message object
-
-    :param d: Message object dict from telegram export
-    :return: Message object for tg-blog model
-    """
-    # Message group quirks
-    grp = d.get("media_group_id")
-    if grp in processed_groups:
-        return None
-    if grp is not None:
-        processed_groups[grp] = d['id']
-
-    def get_group_text():
-        if grp is None:
-            return convert_text(d.get("text"))
-        for msg in groups[grp]:
-            t = convert_text(msg.get("text"))
-            if t:
-                return t
-        return None
-
-    def get_group_images():
-        if d.get("photo") is None:
-            return None
-        if grp is None:
-            return [get_image(d)]
-        return [get_image(m) for m in groups[grp]]
-
-    def get_group_files():
-        if d.get("file") is None:
-            return None
-        if grp is None:
-            return [parse_file(d)]
-        return [parse_file(m) for m in groups[grp]]
-
-    reply = id_map.get(d.get("reply_to_message_id"))
-    # Resolve reply group to the final message id
-    if reply and reply.get('media_group_id'):
-        reply = id_map.get(processed_groups[reply.get("media_group_id")])
-
-    msg = {
-        "id": d["id"],
-        "date": d["date"],
-        "type": None if d.get("type") == "message" else d.get("type"),
-        "text": get_group_text(),
-        "views": d.get("views"),  # Views cannot be exported in the current version
-        "images": get_group_images(),
-        "forwarded_from": d.get("forwarded_from"),
-
-        # TODO: Add this in front end
-        "video": None if d.get("media_type") != "video_file" else {
-            "thumb": d.get("thumbnail"), "duration": d.get("duration_seconds"), "src": d.get("file")
-        },
-        "reply": None if reply is None else {
-            "id": reply['id'],
-            "text": plain_text(reply.get("text")),
-            "thumb": reply.get("thumbnail") or reply.get("photo"),
-        },
-        "author": d.get("author"),
-        "files": get_group_files()
-        # TODO: Add more fields
-    }
-
-    # Convert image file group to photo group
-    if msg.get('files') and msg['files'][0]['media_type'] == 'photo':
-        msg['images'] = msg.pop('files')
-
-    return remove_nones(msg)
-
-
 def infer_groups(msgs: list[dict]):
     """
     Infer message media/file/photo groups from timestamp and media type
@@ -286,81 +157,482 @@ def infer_groups(msgs: list[dict]):
         i += 1
 
 
-p: Path
-id_map: dict[int, dict]
-groups: dict[int, list[dict]]
-processed_groups: dict[int, int]
+def group_by_id(msgs: list[dict]) -> dict[int, list[dict]]:
+    """
+    Bucket messages by media group id in one pass
+    """
+    grouped: dict[int, list[dict]] = {}
+    for d in msgs:
+        if 'media_group_id' in d:
+            grouped.setdefault(d['media_group_id'], []).append(d)
+    return grouped
+
+
+def import_ijson():
+    try:
+        import ijson
+        return ijson
+    except ImportError:
+        printc("&cStreaming mode requires ijson, please install it using 'pip install tgc[stream]'")
+        exit(1)
 
 
-def convert_original_filenames(json_path: Path):
+def stream_messages(json_path: Path) -> Iterator[dict]:
     """
-    Convert filenames in the original result.json
+    Parse the messages of a telegram export incrementally, without loading the whole file into memory
     """
-    renamed: dict[str, str] = {}
-    results = json.loads(json_path.read_text())
+    ijson = import_ijson()
+    with open(json_path, 'rb') as fp:
+        yield from ijson.items(fp, 'messages.item', use_float=True)
+
+
+def stream_reply_ids(json_path: Path) -> set[int]:
+    """
+    Collect the IDs of the messages that are replied to, in a streaming pass that only parses the reply fields
+    """
+    ijson = import_ijson()
+    with open(json_path, 'rb') as fp:
+        return set(ijson.items(fp, 'messages.item.reply_to_message_id'))
+
+
+def stream_groups(msgs: Iterable[dict]) -> Iterator[list[dict]]:
+    """
+    Streaming version of infer_groups: infer media groups from consecutive messages
+
+    :param msgs: Messages in export order
+    :return: Runs of messages, a run with more than one message is a media group (with media_group_id assigned)
+    """
+    c_group = 0
+    c_type = ""
+    c_time = 0
+    run: list[dict] = []
 
-    if results.get('processed'):
-        return
+    def close() -> list[dict]:
+        if len(run) > 1:
+            for m in run:
+                m['media_group_id'] = c_group
+        return run
+
+    for it in msgs:
+        time = int(it['date_unixtime'])
+        ty = "photo" if it.get('photo') else it.get("media_type")
+
+        # Same conditions as infer_groups
+        if ty is not None and ty != "sticker" and ty != 'video' and abs(c_time - time) < 5 and c_type == ty:
+            run.append(it)
+            continue
+
+        if run:
+            yield close()
+        run = [it]
+        c_type = ty
+        c_time = time
+        c_group += 1
+
+    if run:
+        yield close()
+
+
+def reply_ref(d: dict) -> dict:
+    """
+    Compact copy of a message with only the fields needed to resolve replies to it
+    """
+    ref = {k: d[k] for k in ('id', 'thumbnail', 'photo', 'media_group_id') if k in d}
+    ref['text'] = plain_text(d.get('text'))
+    return ref
+
+
+class ExportConverter:
+    """
+    Converter of one telegram export directory into tg-blog posts. All conversion state is kept per instance, so
+    multiple exports can be converted in the same process (or in a process pool, see convert_export).
+    """
+    def __init__(self, path: str | Path, file_jobs: int | None = None):
+        """
+        :param path: Export directory
+        :param file_jobs: Number of threads for file work (stat, sticker conversion, album art extraction)
+        """
+        self.p = Path(path)
+        self.json_path = self.p / "result.json"
+        self.id_map: dict[int, dict] = {}
+        self.groups: dict[int, list[dict]] = {}
+        self.processed_groups: dict[int, int] = {}
+
+        self.file_jobs = file_jobs or os.cpu_count()
+        self.sizes: dict[str, int] = {}
+
+        # Sidecar cache of file conversion results (converted stickers and extracted album art, including failed
+        # extractions), so that reconversions don't spawn processes again
+        self.cache_path = self.p / "tgce_cache.json"
+        self.cache: dict[str, dict[str, str | None]] = {'apng': {}, 'album_art': {}}
+        if self.cache_path.is_file():
+            self.cache |= json.loads(self.cache_path.read_text())
+
+    def save_cache(self):
+        write(self.cache_path, json_stringify(self.cache, indent=2))
+
+    def cached_apng(self, path: str) -> str | None:
+        cached = self.cache['apng'].get(path)
+        return cached if cached and (self.p / cached).is_file() else None
+
+    def convert_tgs(self, path: str) -> str:
+        """
+        Convert a tgs sticker to apng (cached)
+
+        :param path: Sticker path relative to the export directory
+        :return: Converted path relative to the export directory
+        """
+        cached = self.cached_apng(path)
+        if cached:
+            return cached
+
+        out = str(tgs_to_apng(self.p / path).relative_to(self.p))
+        if out.endswith(".apng"):
+            self.cache['apng'][path] = out
+        return out
+
+    def album_art(self, path: str) -> str | None:
+        """
+        Extract the album art of an audio file (cached, including files without album art)
+
+        :param path: Audio path relative to the export directory
+        :return: Album art path relative to the export directory, or None if there isn't one
+        """
+        if path in self.cache['album_art']:
+            return self.cache['album_art'][path]
+
+        op = extract_album_art(self.p / path)
+        op = str(op.relative_to(self.p)) if op else None
+        self.cache['album_art'][path] = op
+        return op
+
+    def prefetch(self, msgs: list[dict]):
+        """
+        Run the file work of parse_file for all messages up front on a thread pool: file sizes, sticker
+        conversions (in batches) and album art extraction. Results are used by parse_file and saved to the cache.
+
+        :param msgs: Message object dicts from telegram export
+        """
+        files = [d for d in msgs if d.get("file")]
+        paths = {d["file"] for d in files} | {d["thumbnail"] for d in files if d.get("thumbnail")}
+
+        tgs = [t for t in paths if t.endswith(".tgs") and not self.cached_apng(t)]
+        audio = {d["file"] for d in files if d.get("media_type") == 'audio_file' and not d.get("thumbnail")}
+        audio = [a for a in audio if a not in self.cache['album_art']]
+
+        printc(f"&7Prefetching {len(files)} files ({len(tgs)} stickers to convert, {len(audio)} audio files to "
+               f"extract album art from) with {self.file_jobs} threads...")
+        with ThreadPoolExecutor(self.file_jobs) as pool:
+            batches = [tgs[i:i + LOTTIE_BATCH_SIZE] for i in range(0, len(tgs), LOTTIE_BATCH_SIZE)]
+            converted = pool.map(lambda b: tgs_to_apng_batch([self.p / t for t in b]), batches)
+            arts = pool.map(self.album_art, audio)
+            sizes = pool.map(lambda f: os.path.getsize(self.p / f), [d["file"] for d in files])
+
+            for batch, outs in zip(batches, converted):
+                for t, out in zip(batch, outs):
+                    if out.suffix == ".apng":
+                        self.cache['apng'][t] = str(out.relative_to(self.p))
+            list(arts)
+            self.sizes = dict(zip([d["file"] for d in files], sizes))
+
+        self.save_cache()
+
+    def process_file_path(self, path: str | None) -> str | None:
+        """
+        Ensure file paths are url-safe
+        """
+        if path is None:
+            return None
+
+        # Convert tgs stickers to apng
+        if path.endswith(".tgs"):
+            path = self.convert_tgs(path)
+
+        return path
+
+    def parse_file(self, d: dict) -> dict | None:
+        file = d.get("file")
+        if file is None:
+            return None
+
+        # Create file
+        file = {
+            "url": self.process_file_path(file),
+            "thumb": self.process_file_path(d.get("thumbnail")),
+            "mime_type": d.get("mime_type"),
+            "size": self.sizes.get(file) or os.path.getsize(self.p / file),
+            "original_name": d.get("original_name"),
+
+            # Media
+            "media_type": d.get("media_type"),
+
+            # Video/audio/gif
+            "duration": d.get("duration_seconds"),
+
+            # Video/sticker/gif
+            "width": d.get("width"),
+            "height": d.get("height"),
+
+            # Sticker
+            "sticker_emoji": d.get("sticker_emoji"),
+
+            # Audio
+            "title": d.get("title"),
+            "performer": d.get("performer")
+        }
+
+        # Convert image file to photo
+        if not file['media_type'] and file['mime_type'].startswith('image'):
+            file['media_type'] = "photo"
+
+        # Add image for missing album cover art
+        if file['media_type'] == 'audio_file' and not file['thumb']:
+            file['thumb'] = self.album_art(file['url'])
+
+        return file
+
+    def convert_msg(self, d: dict) -> dict | None:
+        """
+        Convert a message object
+
+        :param d: Message object dict from telegram export
+        :return: Message object for tg-blog model
+        """
+        # Message group quirks
+        grp = d.get("media_group_id")
+        if grp in self.processed_groups:
+            return None
+        if grp is not None:
+            self.processed_groups[grp] = d['id']
+
+        def get_group_text():
+            if grp is None:
+                return convert_text(d.get("text"))
+            for msg in self.groups[grp]:
+                t = convert_text(msg.get("text"))
+                if t:
+                    return t
+            return None
+
+        def get_group_images():
+            if d.get("photo") is None:
+                return None
+            if grp is None:
+                return [get_image(d)]
+            return [get_image(m) for m in self.groups[grp]]
+
+        def get_group_files():
+            if d.get("file") is None:
+                return None
+            if grp is None:
+                return [self.parse_file(d)]
+            return [self.parse_file(m) for m in self.groups[grp]]
+
+        reply = self.id_map.get(d.get("reply_to_message_id"))
+        # Resolve reply group to the final message id
+        if reply and reply.get('media_group_id'):
+            reply = self.id_map.get(self.processed_groups[reply.get("media_group_id")])
+
+        msg = {
+            "id": d["id"],
+            "date": d["date"],
+            "type": None if d.get("type") == "message" else d.get("type"),
+            "text": get_group_text(),
+            "views": d.get("views"),  # Views cannot be exported in the current version
+            "images": get_group_images(),
+            "forwarded_from": d.get("forwarded_from"),
+
+            # TODO: Add this in front end
+            "video": None if d.get("media_type") != "video_file" else {
+                "thumb": d.get("thumbnail"), "duration": d.get("duration_seconds"), "src": d.get("file")
+            },
+            "reply": None if reply is None else {
+                "id": reply['id'],
+                "text": plain_text(reply.get("text")),
+                "thumb": reply.get("thumbnail") or reply.get("photo"),
+            },
+            "author": d.get("author"),
+            "files": get_group_files()
+            # TODO: Add more fields
+        }
+
+        # Convert image file group to photo group
+        if msg.get('files') and msg['files'][0]['media_type'] == 'photo':
+            msg['images'] = msg.pop('files')
+
+        return remove_nones(msg)
+
+    def rename_files(self, r: dict, renamed: dict[str, str]):
+        """
+        Rename the files of a message in the original export to url-safe file names
+
+        :param r: Message object dict from telegram export (will be modified)
+        :param renamed: Original path to renamed path of the files renamed so far (will be modified)
+        """
+        for k in ['file', 'thumbnail']:
+            if k not in r:
+                continue
 
-    for k in ['file', 'thumbnail']:
-        for r in [r for r in results['messages'] if k in r]:
             orig = str(r[k])
             if orig in renamed:
                 r[k] = renamed[orig]
                 continue
 
-            f = p / r[k]
+            f = self.p / r[k]
             new = f.with_name(f"{r['id']}{'_thumb' if k == 'thumbnail' else ''}{f.suffix}")
-            np = str(new.relative_to(p))
+            np = str(new.relative_to(self.p))
             if new != f:
-                printc(f"&6Renaming &r{orig} &6to &r{np}")
-                shutil.move(f, new)
+                # In streaming mode, result.json isn't rewritten, so the file might be renamed in a previous run
+                if f.exists() or not new.exists():
+                    printc(f"&6Renaming &r{orig} &6to &r{np}")
+                    shutil.move(f, new)
                 if k == 'file':
                     r['original_name'] = f.name
                 r[k] = np
                 renamed[orig] = np
-    results['processed'] = True
 
-    write(json_path, json_stringify(results, indent=2))
+    def convert_original_filenames(self):
+        """
+        Convert filenames in the original result.json
+        """
+        renamed: dict[str, str] = {}
+        results = json.loads(self.json_path.read_text())
+
+        if results.get('processed'):
+            return
+
+        for r in results['messages']:
+            self.rename_files(r, renamed)
+        results['processed'] = True
+
+        write(self.json_path, json_stringify(results, indent=2))
+
+    def convert_all(self) -> list[dict]:
+        """
+        Convert all messages of the export in memory
+
+        :return: Converted messages
+        """
+        # Convert file names to url-safe file names
+        self.convert_original_filenames()
+
+        # Read export result json
+        j: list[dict] = json.loads(self.json_path.read_text())["messages"]
+        self.id_map = {d['id']: d for d in j}
+
+        # Assign groups
+        infer_groups(j)
+
+        # Group groups
+        self.groups = group_by_id(j)
+        self.processed_groups = {}
+
+        # Run file work in parallel
+        self.prefetch(j)
+
+        # Convert
+        j = [self.convert_msg(d) for d in j]
+        self.save_cache()
+        return [d for d in j if d is not None]
+
+    def convert_stream(self) -> Iterator[dict]:
+        """
+        Convert messages while streaming them from the export. Files are renamed on the fly (result.json isn't
+        rewritten). A first pass collects the IDs of the messages that are replied to, and only compact references of
+        those (and of the first message of their media groups, which replies resolve to) are kept.
+
+        :return: Converted messages
+        """
+        self.id_map, self.groups, self.processed_groups = {}, {}, {}
+        renamed: dict[str, str] = {}
+        reply_ids = stream_reply_ids(self.json_path)
+
+        def renamed_msgs() -> Iterator[dict]:
+            for r in stream_messages(self.json_path):
+                self.rename_files(r, renamed)
+                yield r
+
+        for grp in stream_groups(renamed_msgs()):
+            replied = [d for d in grp if d['id'] in reply_ids]
+            if replied:
+                self.id_map.update({d['id']: reply_ref(d) for d in [grp[0], *replied]})
+            gid = grp[0].get('media_group_id')
+            if gid is not None:
+                self.groups[gid] = grp
+
+            for d in grp:
+                msg = self.convert_msg(d)
+                if msg is not None:
+                    yield msg
+
+            self.groups.pop(gid, None)
+
+    def convert(self, stream: bool = False, page_size: int | None = None) -> int:
+        """
+        Convert the export and write posts.json and index.html into the export directory
+
+        :param stream: Parse the export and write posts incrementally (bounded memory, requires ijson)
+        :param page_size: Write paged output with this many posts per page, instead of one posts.json
+        :return: Number of posts written
+        """
+        assert self.json_path.is_file(), f"Error: File {self.json_path} not found"
+
+        if stream:
+            n = write_posts(self.p, self.convert_stream(), page_size)
+            self.save_cache()
+            return n
+
+        return write_posts(self.p, self.convert_all(), page_size)
+
+
+def convert_export(path: str | Path, stream: bool = False, file_jobs: int | None = None,
+                   page_size: int | None = None) -> int:
+    """
+    Convert one export directory (picklable entry point for process pools)
+
+    :return: Number of posts written
+    """
+    n = ExportConverter(path, file_jobs).convert(stream, page_size)
+    printc(f"&aDone! Saved {n} posts to {path} ({change_summary(Path(path))})")
+    return n
 
 
 def run():
-    global p, id_map, groups, processed_groups
     parser = argparse.ArgumentParser("Telegram export converter",
                                      description="A tool to convert exported json into tg-blog json")
-    parser.add_argument("dir", help="Export directory")
+    parser.add_argument("dir", nargs="+", help="Export directories")
+    parser.add_argument("--stream", action="store_true",
+                        help="Parse the export and write posts incrementally (bounded memory, requires ijson)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of exports to convert concurrently in separate processes")
+    parser.add_argument("--page-size", type=int, default=None,
+                        help="Write posts into pages of this size (with posts/manifest.json) instead of one posts.json")
+    parser.add_argument("--file-jobs", type=int, default=None,
+                        help="Number of threads for file work in each export (default: number of CPUs)")
     args = parser.parse_args()
 
-    p = Path(args.dir)
-    f = p / "result.json"
-    assert f.is_file(), f"Error: File {f} not found"
-
-    # Convert file names to url-safe file names
-    convert_original_filenames(f)
-
-    # Read export result json
-    j: list[dict] = json.loads(f.read_text())["messages"]
-    id_map = {d['id']: d for d in j}
-
-    # Assign groups
-    infer_groups(j)
-
-    # Group groups
-    tmp_grouped: list[dict] = [d for d in j if 'media_group_id' in d]
-    group_ids: set[int] = {d['media_group_id'] for d in tmp_grouped}
-    groups = {g: [d for d in tmp_grouped if d['media_group_id'] == g] for g in group_ids}
-    processed_groups = {}
-
-    # print(json.dumps(j, indent=2, ensure_ascii=False))
-
-    # Convert
-    j = [convert_msg(d) for d in j]
-    j = [d for d in j if d is not None]
-
-    write(p / "posts.json", json_stringify(j, indent=2))
-    write(p / "index.html", HTML.replace("$$POSTS_DATA$$", json_stringify(j)))
-
-    printc(f"&aDone! Saved to {p / 'posts.json'}")
+    failed = []
+    if args.jobs <= 1 or len(args.dir) == 1:
+        for d in args.dir:
+            try:
+                convert_export(d, args.stream, args.file_jobs, args.page_size)
+            except Exception as e:
+                printc(f"&cFailed to convert {d}: {e!r}")
+                failed.append(d)
+    else:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            futures = {pool.submit(convert_export, d, args.stream, args.file_jobs, args.page_size): d
+                       for d in args.dir}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                except Exception as e:
+                    printc(f"&cFailed to convert {futures[fut]}: {e!r}")
+                    failed.append(futures[fut])
+
+    if failed:
+        printc(f"&cFailed exports: {', '.join(failed)}")
+        exit(1)
 
 
 if __name__ == '__main__':
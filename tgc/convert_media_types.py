@@ -1,10 +1,15 @@
+import asyncio
+import contextvars
+import json
 import os
 import zlib
+from concurrent.futures import Executor, Future
 from pathlib import Path
 from shutil import which
-from subprocess import check_call, CalledProcessError, check_output
+from subprocess import check_call, CalledProcessError, check_output, run
+from typing import Callable, Any
 
-from hypy_utils import printc
+from .pyro.log import log
 
 
 SCRIPT_PATH = Path(__file__).parent
@@ -18,6 +23,10 @@ NODE_BIN_PATHS: list[Path] = [
     Path('/usr/bin')
 ]
 
+# Node script that renders many lottie animations with one headless browser
+LOTTIE_BATCH_JS = SCRIPT_PATH / 'lottie_batch.js'
+LOTTIE_BATCH_SIZE = 64
+
 
 def find_node_bin(name: str, pkg_name: str) -> Path | None:
     # Find bin path
@@ -29,8 +38,8 @@ def find_node_bin(name: str, pkg_name: str) -> Path | None:
         if (bin / name).is_file():
             return bin / name
 
-    printc(f"&eWarning! Cannot find node executable {name}. \n"
-           f"Make sure to install it using 'yarn global add {pkg_name}'")
+    log(f"&eWarning! Cannot find node executable {name}. \n"
+        f"Make sure to install it using 'yarn global add {pkg_name}'")
     return None
 
 
@@ -61,6 +70,47 @@ def tgs_to_apng(tgs: str | Path) -> Path:
     return out
 
 
+def tgs_to_apng_batch(tgs_files: list[str | Path]) -> list[Path]:
+    """
+    Convert many .tgs vector animations into .apng with one headless browser session (see lottie_batch.js),
+    instead of launching a browser for every animation. Animations that fail to render in the batch (or all of
+    them, if the batch renderer can't run) fall back to tgs_to_apng one by one.
+
+    :param tgs_files: TGS files
+    :return: Converted paths, in the same order
+    """
+    tgs_files = [Path(t) for t in tgs_files]
+    todo = [t for t in tgs_files if not t.with_suffix(".apng").is_file()]
+    node = which("node")
+
+    if todo and node and LOTTIE_BATCH_JS.is_file():
+        jobs = []
+        for t in todo:
+            t.with_suffix(".json").write_bytes(zlib.decompress(t.read_bytes(), 15 + 32))
+            jobs.append(json.dumps({'input': str(t.with_suffix(".json").absolute()),
+                                    'output': str(t.with_suffix(".apng").absolute())}))
+
+        # Let the script find puppeteer-lottie in the same places as the cli
+        node_path = [os.getenv('NODE_PATH')] + [str(b.parent) for b in NODE_BIN_PATHS if b.name == '.bin']
+        env = os.environ | {'NODE_PATH': os.pathsep.join(p for p in node_path if p)}
+
+        try:
+            proc = run([node, LOTTIE_BATCH_JS], input='\n'.join(jobs), capture_output=True, text=True, env=env)
+            for line in proc.stdout.splitlines():
+                r = json.loads(line)
+                if not r['ok']:
+                    log(f"&e> Batch render of {r['output']} failed: {r['error']}")
+            if proc.returncode:
+                log(f"&e> Batch lottie renderer exited with {proc.returncode}: {proc.stderr.strip()}")
+        except (OSError, ValueError) as e:
+            log(f"&e> Batch lottie renderer failed: {e!r}")
+        finally:
+            for t in todo:
+                t.with_suffix(".json").unlink(missing_ok=True)
+
+    return [t.with_suffix(".apng") if t.with_suffix(".apng").is_file() else tgs_to_apng(t) for t in tgs_files]
+
+
 def webm_to_apng(webm: str, p: Path) -> str:
     """
     Convert .webm contained animation into .apng bitmap animation
@@ -78,7 +128,7 @@ def webm_to_apng(webm: str, p: Path) -> str:
                '-i', str(p / webm),
                '-plays', '0',
                str(p / out)]
-        print(' '.join(cmd))
+        log(' '.join(cmd))
         check_call(cmd)
 
     return out
@@ -92,7 +142,81 @@ def extract_album_art(f: Path) -> Path | None:
 
     try:
         check_output(['ffmpeg', '-y', '-i', f, '-an', '-vf', 'scale=250:-1', op])
-        printc(f"&a> Success! Saved to {op}")
+        log(f"&a> Success! Saved to {op}")
         return op
     except CalledProcessError as e:
-        printc(f"&c> Failed to extract album art: {e}")
+        log(f"&c> Failed to extract album art: {e}")
+
+
+class ConversionQueue:
+    """
+    Queue of blocking media conversions (which mostly wait for puppeteer/ffmpeg subprocesses)
+
+    Conversions run on a bounded executor as soon as they're submitted, so they overlap with network I/O on the
+    event loop. Their results are only applied to the output after the queue drains.
+
+    TGS stickers are collected and rendered in batches of LOTTIE_BATCH_SIZE, with one headless browser per batch.
+    """
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self.pending: list[tuple[Future, Callable[[Any], None] | None]] = []
+        self.tgs: list[tuple[Path, Callable[[Path], None] | None]] = []
+
+    def submit(self, fn: Callable, *args, then: Callable[[Any], None] | None = None) -> Future:
+        """
+        Submit a conversion
+
+        :param fn: Conversion function (e.g. tgs_to_apng)
+        :param then: Callback to apply the result, called when the queue drains
+        """
+        # Run in a copy of the current context, so that the conversion logs with the prefix of its export
+        fut = self.executor.submit(contextvars.copy_context().run, fn, *args)
+        self.pending.append((fut, then))
+        return fut
+
+    def submit_tgs(self, tgs: Path, then: Callable[[Path], None] | None = None):
+        """
+        Submit a TGS sticker to be converted to APNG in a batch
+
+        :param tgs: TGS file
+        :param then: Callback to apply the converted path, called when the queue drains
+        """
+        self.tgs.append((tgs, then))
+        if len(self.tgs) >= LOTTIE_BATCH_SIZE:
+            self.flush_tgs()
+
+    def flush_tgs(self):
+        """
+        Submit the collected TGS stickers as one batch
+        """
+        batch, self.tgs = self.tgs, []
+        if not batch:
+            return
+
+        def then(outs: list[Path]):
+            for (_, cb), out in zip(batch, outs):
+                if cb:
+                    cb(out)
+
+        self.submit(tgs_to_apng_batch, [t for t, _ in batch], then=then)
+
+    async def drain(self):
+        """
+        Wait for every submitted conversion, and apply the results in submission order
+        """
+        self.flush_tgs()
+        pending, self.pending = self.pending, []
+        if pending:
+            log(f"&7Waiting for {sum(not f.done() for f, _ in pending)} of {len(pending)} conversions...")
+        for fut, then in pending:
+            try:
+                result = await asyncio.wrap_future(fut)
+            except Exception as e:
+                log(f"&c> Conversion failed: {e!r}")
+                continue
+            if not then:
+                continue
+            try:
+                then(result)
+            except Exception as e:
+                log(f"&c> Failed to apply conversion result {result!r}: {e!r}")
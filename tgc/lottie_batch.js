@@ -0,0 +1,29 @@
+// Render many lottie animations with one long-lived headless browser, instead of launching one per animation
+// Input (stdin): one JSON job per line, {"input": "sticker.json", "output": "sticker.apng"}
+// Output (stdout): one JSON result per line, {"output": "sticker.apng", "ok": true} or {..., "ok": false, "error": "..."}
+const readline = require('readline')
+const puppeteer = require('puppeteer')
+const renderLottie = require('puppeteer-lottie')
+
+async function main() {
+  const browser = await puppeteer.launch()
+  const lines = readline.createInterface({ input: process.stdin })
+
+  for await (const line of lines) {
+    if (!line.trim()) continue
+    const job = JSON.parse(line)
+    try {
+      await renderLottie({ path: job.input, output: job.output, browser, quiet: true })
+      console.log(JSON.stringify({ output: job.output, ok: true }))
+    } catch (e) {
+      console.log(JSON.stringify({ output: job.output, ok: false, error: String(e) }))
+    }
+  }
+
+  await browser.close()
+}
+
+main().catch(e => {
+  console.error(e)
+  process.exit(1)
+})
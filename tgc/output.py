@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, IO
+
+from hypy_utils import json_stringify, ensure_dir
+
+from .pyro.consts import HTML, PAGED_HTML
+from .pyro.log import log
+
+MANIFEST_VERSION = 1
+
+# Artifacts written in this process, and whether their content changed
+changes: dict[Path, bool] = {}
+
+
+def file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_open(path: Path) -> Iterator[IO[str]]:
+    """
+    Open a file for writing atomically: the content is written into a temporary file, which only replaces the
+    file if its content hash differs. A crash mid-write never leaves a truncated file, and identical files are
+    left untouched (keeping their mtime, so git and CDNs don't see a change).
+
+    :param path: File path
+    """
+    ensure_dir(path.parent)
+    tmp = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            yield f
+        changed = not path.is_file() or path.stat().st_size != tmp.stat().st_size or file_hash(path) != file_hash(tmp)
+        if changed:
+            os.replace(tmp, path)
+        changes[path] = changed
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def write_atomic(path: Path, content: str, artifact: bool = True) -> bool:
+    """
+    Write a file atomically, skipping it if the content is identical (see atomic_open)
+
+    :param artifact: Whether the file is an output artifact, which change_summary reports
+    :return: Whether the file changed
+    """
+    with atomic_open(path) as f:
+        f.write(content)
+    return changes[path] if artifact else changes.pop(path)
+
+
+def change_summary(root: Path) -> str:
+    """
+    Summarize which artifacts under a directory changed in this run
+    """
+    root = root.absolute()
+    written = {p: c for p, c in changes.items() if p.absolute().is_relative_to(root)}
+    changed = [str(p.absolute().relative_to(root)) for p, c in written.items() if c]
+    return f"{len(changed)} of {len(written)} artifacts changed" + (f": {', '.join(changed)}" if changed else "")
+
+
+def load_posts(path: Path) -> list[dict]:
+    """
+    Load the posts of an export, either from posts.json or from the paged output
+
+    :param path: Export path
+    :return: Posts, or an empty list if there's no output yet
+    """
+    if (path / "posts.json").is_file():
+        return json.loads((path / "posts.json").read_text())
+
+    mp = path / "posts" / "manifest.json"
+    if mp.is_file():
+        pages = json.loads(mp.read_text())['pages']
+        return [post for page in pages for post in json.loads((path / "posts" / page['file']).read_text())]
+
+    return []
+
+
+def write_single(path: Path, posts: Iterable[dict]) -> int:
+    """
+    Write posts.json and index.html (with the posts inlined) while consuming the posts one by one
+
+    :param path: Output directory
+    :param posts: Converted posts
+    :return: Number of posts written
+    """
+    head, tail = HTML.split("$$POSTS_DATA$$")
+    n = 0
+    with atomic_open(path / "posts.json") as pj, atomic_open(path / "index.html") as ih:
+        pj.write("[")
+        ih.write(head + "[")
+        for post in posts:
+            sep = "," if n else ""
+            pj.write(sep + "\n  " + json_stringify(post, indent=2).replace("\n", "\n  "))
+            ih.write(sep + json_stringify(post))
+            n += 1
+        pj.write("\n]" if n else "]")
+        ih.write("]" + tail)
+    return n
+
+
+def write_paged(path: Path, posts: Iterable[dict], page_size: int) -> int:
+    """
+    Write posts into fixed-size pages under posts/, with a small manifest listing the pages. Pages whose content
+    didn't change are not rewritten, so an incremental run usually only rewrites the last page. index.html loads the
+    manifest instead of inlining every post.
+
+    :param path: Output directory
+    :param posts: Converted posts, sorted by ID
+    :param page_size: Number of posts per page
+    :return: Number of posts written
+    """
+    d = ensure_dir(path / "posts")
+    mp = d / "manifest.json"
+    old = {p['file']: p['hash'] for p in json.loads(mp.read_text())['pages']} if mp.is_file() else {}
+
+    pages: list[dict] = []
+    buf: list[dict] = []
+    changed: list[str] = []
+
+    def flush():
+        content = json_stringify(buf, indent=2)
+        name = f"page-{len(pages):05d}.json"
+        h = hashlib.sha256(content.encode()).hexdigest()[:16]
+        if old.get(name) != h or not (d / name).is_file():
+            if write_atomic(d / name, content):
+                changed.append(name)
+        else:
+            # Skipped without writing, recorded as unchanged like atomic_open does
+            changes[d / name] = False
+        pages.append({'file': name, 'hash': h, 'count': len(buf), 'first_id': buf[0]['id'], 'last_id': buf[-1]['id']})
+
+    n = 0
+    for post in posts:
+        buf.append(post)
+        n += 1
+        if len(buf) >= page_size:
+            flush()
+            buf = []
+    if buf:
+        flush()
+
+    # Remove pages that no longer exist
+    for name in set(old) - {p['file'] for p in pages}:
+        (d / name).unlink(missing_ok=True)
+
+    write_atomic(mp, json_stringify({'version': MANIFEST_VERSION, 'total': n, 'page_size': page_size,
+                                     'pages': pages}, indent=2))
+    write_atomic(path / "index.html", PAGED_HTML)
+
+    # posts.json would take precedence over the pages in load_posts
+    (path / "posts.json").unlink(missing_ok=True)
+
+    log(f"&7> Rewrote {len(changed)} of {len(pages)} pages")
+    return n
+
+
+def write_posts(path: Path, posts: Iterable[dict], page_size: int | None = None) -> int:
+    """
+    Write the converted posts of an export
+
+    :param path: Output directory
+    :param posts: Converted posts, sorted by ID
+    :param page_size: Write paged output with this many posts per page, instead of one posts.json
+    :return: Number of posts written
+    """
+    if page_size:
+        return write_paged(path, posts, int(page_size))
+    return write_single(path, posts)
@@ -12,6 +12,11 @@ class Config:
     api_hash: str
     bot_token: str
     exports: list[dict]
+    rate_limits: dict[str, list[float]] | None = None
+    max_concurrent_exports: int = 1
+    media_store: str | None = None
+    message_store: str | None = None
+    conversion_workers: int | None = None
 
 
 def load_config(path: str = "config.toml") -> Config:
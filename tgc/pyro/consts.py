@@ -21,3 +21,4 @@ MEDIA_TYPE_MAP: dict[MessageMediaType, str] = {
 }
 
 HTML = (Path(__file__).parent.parent / "tg-blog.html").read_text()
+PAGED_HTML = (Path(__file__).parent.parent / "tg-blog-paged.html").read_text()
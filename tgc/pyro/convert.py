@@ -72,10 +72,15 @@ def entity_start_end(text: str, en: MessageEntity) -> tuple[str, str] | None:
 def convert_text(text: str, entities: list[MessageEntity]) -> str:
     """
     Convert text to HTML
+
+    All tag boundaries are sorted once and joined in a single pass. Tags at the same offset keep the order in which
+    they're collected (each entity's start tag, then its end tag), which is the order of the previous implementation
+    that spliced tags into the text one by one. tools/bench/convert_text.py checks the output against a golden corpus.
     """
     text = utils.add_surrogates(text)
 
-    entities_offsets = []
+    # (offset, insertion index, tag), the insertion index breaks ties so tags are never compared
+    bounds: list[tuple[int, int, str]] = []
 
     for entity in entities:
         start = entity.offset
@@ -85,19 +90,17 @@ def convert_text(text: str, entities: list[MessageEntity]) -> str:
         if tags is None:
             continue
 
-        entities_offsets.append((tags[0], start,))
-        entities_offsets.append((tags[1], end,))
+        bounds.append((start, len(bounds), tags[0]))
+        bounds.append((end, len(bounds), tags[1]))
 
-    entities_offsets = map(
-        lambda x: x[1],
-        sorted(
-            enumerate(entities_offsets),
-            key=lambda x: (x[1][1], x[0]),
-            reverse=True
-        )
-    )
+    bounds.sort()
 
-    for entity, offset in entities_offsets:
-        text = text[:offset] + entity + text[offset:]
+    out = []
+    last = 0
+    for offset, _, tag in bounds:
+        out.append(text[last:offset])
+        out.append(tag)
+        last = max(last, offset)
+    out.append(text[last:])
 
-    return utils.remove_surrogates(text)
+    return utils.remove_surrogates("".join(out))
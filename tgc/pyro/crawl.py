@@ -1,24 +1,40 @@
 import argparse
 import asyncio
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import AsyncIterator
 
 from PIL import Image
-from hypy_utils import printc, json_stringify, write
 from hypy_utils.dict_utils import remove_keys
 from pyrogram import Client
+from pyrogram.enums import MessageEntityType
 from pyrogram.file_id import FileId
-from pyrogram.types import User, Chat, Message, Sticker
+from pyrogram.types import User, Chat, Message, Sticker, MessageEntity
 
 from .config import load_config, Config
-from .consts import HTML
 from .convert import convert_text, convert_media_dict
-from .download_media import download_media, has_media, guess_ext, download_media_urlsafe
-from .grouper import group_msgs
+from .download_media import download_media, has_media, guess_ext, download_media_urlsafe, ThumbnailQueue
+from .grouper import merge_tail, tail_start, group_msgs, album_members
+from .history import fetch_windows, latest_message_id, WINDOW_SIZE
+from .log import log, log_prefix
+from .ratelimit import limiter
+from .scheduler import gather_bounded, stream_bounded
+from .state import load_state, save_state, CrawlState
+from .store import MessageStore, ReplyIndex, STORE_FILE, DEFAULT_STORE_DIR
 from ..convert_export import remove_nones
-from ..convert_media_types import tgs_to_apng
+from ..convert_media_types import ConversionQueue
+from ..output import load_posts, write_posts, change_summary
 from ..rss.posts_to_feed import posts_to_feed, FeedMeta
 
 
+EMOJI_SRC_RE = re.compile(r'<i class="custom-emoji" emoji-src="emoji/(\d+)">')
+
+
 def effective_text(msg: Message) -> str:
     """
     Get effective text of a message in HTML
@@ -31,6 +47,23 @@ def effective_text(msg: Message) -> str:
         return str(msg.service).split(".")[-1].replace("_", " ").capitalize()
 
 
+def raw_text(raw: dict) -> str | None:
+    """
+    Get effective text of a stored raw message in HTML (same as effective_text)
+    """
+    def entities(key: str) -> list[MessageEntity]:
+        return [MessageEntity(type=MessageEntityType[e['type'].split(".")[-1]], offset=e['offset'],
+                              length=e['length'], url=e.get('url'), language=e.get('language'),
+                              custom_emoji_id=e.get('custom_emoji_id')) for e in raw.get(key) or []]
+
+    if raw.get('text'):
+        return convert_text(raw['text'], entities('entities'))
+    if raw.get('caption'):
+        return convert_text(raw['caption'], entities('caption_entities'))
+    if raw.get('service'):
+        return raw['service'].split(".")[-1].replace("_", " ").capitalize()
+
+
 def _download_media_helper(args: list) -> Path:
     return asyncio.run(download_media(app, *args))
 
@@ -42,8 +75,54 @@ def get_user_name(user: User) -> str:
     return name
 
 
-async def process_message(msg: Message, path: Path, export: dict) -> dict:
+def media_store(export: dict) -> Path | None:
+    """
+    Get the content-addressed media store of an export (per-export setting overrides the global one)
+    """
+    store = export.get('media_store') or cfg.media_store
+    return Path(store) if store else None
+
+
+def message_store(export: dict) -> Path:
+    """
+    Get the directory of the local message store of an export
+
+    A per-export setting is the store directory itself, while the global one is a base directory with a store for each
+    export (named after the export directory and the chat ID).
+    """
+    if export.get('message_store'):
+        return Path(export['message_store'])
+    base = Path(cfg.message_store) if cfg.message_store else DEFAULT_STORE_DIR
+    return base / f"{Path(export['path']).name}_{export['chat_id']}"
+
+
+def image_size(fp: Path) -> tuple[int, int]:
+    """
+    Read image dimensions from the file header (PIL doesn't decode the image until it's needed)
+    """
+    with Image.open(fp) as im:
+        return im.size
+
+
+@dataclass
+class ExportContext:
+    """
+    Per-run state of an export, shared by the processing of its messages
+    """
+    path: Path
+    export: dict
+    state: CrawlState
+    conv: ConversionQueue
+    thumbs: ThumbnailQueue
+    store: MessageStore
+    # Custom emoji ids to the records that use them
+    emojis: dict[int, list[dict]] = field(default_factory=dict)
+
+
+async def process_message(msg: Message, ctx: ExportContext) -> dict:
+    path, export = ctx.path, ctx.export
     media_path = path / "media"
+    ctx.store.put_raw(msg)
 
     m = {
         "id": msg.id,
@@ -69,28 +148,37 @@ async def process_message(msg: Message, path: Path, export: dict) -> dict:
     # Download file
     f = m.get('file')
 
+    # Record to return. Its file is a cleaned copy of f, so background work that finishes after this message is
+    # processed (sticker conversions, thumbnails) updates it through update_file
+    r: dict = {}
+
+    def update_file(**kwargs):
+        (r.get('file') or r.get('image') or f).update(kwargs)
+
+    def rel(fp: Path) -> str:
+        # Downloads return absolute paths, while the export path may be relative
+        return str(fp.absolute().relative_to(path.absolute()))
+
     async def dl_media():
         fp, name = await download_media_urlsafe(app, msg, directory=media_path,
-                                                max_file_size=int((export.get('size_limit_mb') or 0) * 1000_000))
+                                                max_file_size=int((export.get('size_limit_mb') or 0) * 1000_000),
+                                                store=media_store(export))
         if fp is None:
             return
         f['original_name'] = name
 
-        # Convert tgs sticker
-        if fp.suffix == '.tgs':
-            fp = Path(tgs_to_apng(fp))
-
-        f['url'] = str(fp.absolute().relative_to(path.absolute()))
+        f['url'] = rel(fp)
         f['size'] = f.pop('file_size', None)
 
-        # Download the largest thumbnail
+        # Convert tgs sticker in the background, the url is updated when the conversion queue drains
+        if fp.suffix == '.tgs':
+            ctx.conv.submit_tgs(fp, then=lambda out: update_file(url=rel(out)))
+            fp = fp.with_suffix('.apng')
+
+        # Queue the thumbnail, it's downloaded after the primary media
         if f.get('thumbs'):
-            thumb: dict = max(f['thumbs'], key=lambda x: x['file_size'])
-            ext = guess_ext(app, FileId.decode(thumb['file_id']).file_type, None)
-            fp = await download_media(app, thumb['file_id'], directory=media_path,
-                                      fname=fp.with_suffix(fp.suffix + f'_thumb{ext}').name)
-            f['thumb'] = str(fp.absolute().relative_to(path.absolute()))
-            del f['thumbs']
+            ctx.thumbs.add(f.pop('thumbs'), f'{fp.name}_thumb',
+                           then=lambda tp: update_file(thumb=rel(tp)))
 
     if has_media(msg):
         await dl_media()
@@ -101,95 +189,260 @@ async def process_message(msg: Message, path: Path, export: dict) -> dict:
         if mt == 'photo' or (not mt and (f.get('mime_type') or "").startswith("image")):
             img = m['image'] = m.pop('file')
 
-            # Read image size
-            img['width'], img['height'] = Image.open(path / img['url']).size
+            # Read image size: photos already have it in the metadata, otherwise read (and cache) it from the file
+            if 'url' in img and not (img.get('width') and img.get('height')):
+                sizes = ctx.state.image_sizes
+                if img['url'] not in sizes:
+                    sizes[img['url']] = list(image_size(path / img['url']))
+                img['width'], img['height'] = sizes[img['url']]
+
+    r.update(remove_keys(remove_nones(m), {'file_id', 'file_unique_id'}))
+    for eid in custom_emoji_ids(msg):
+        ctx.emojis.setdefault(eid, []).append(r)
+    return r
 
-    return remove_keys(remove_nones(m), {'file_id', 'file_unique_id'})
 
+def custom_emoji_ids(msg: Message) -> set[int]:
+    entities = (msg.text.entities if msg.text else None) or msg.caption_entities or []
+    return {e.custom_emoji_id for e in entities if e.custom_emoji_id}
 
-async def download_custom_emojis(msgs: list[Message], results: list[dict], path: Path):
-    print("Downloading custom emojis...")
-    # List custom emoji ids
-    ids = {e.custom_emoji_id for msg in msgs if msg.text and msg.text.entities for e in msg.text.entities if e.custom_emoji_id}
-    ids.update({e.custom_emoji_id for msg in msgs if msg.caption_entities for e in msg.caption_entities if e.custom_emoji_id})
-    ids = list(ids)
-    orig_ids = list(ids)
+
+async def download_custom_emojis(index: dict[int, list[dict]], path: Path, export: dict):
+    """
+    Download custom emojis, and replace their ids with the downloaded paths
+
+    :param index: Custom emoji ids to the records that use them
+    """
+    log("Downloading custom emojis...")
+    ids = list(index)
 
     # Query stickers 200 ids at a time
     stickers: list[Sticker] = []
-    while ids:
-        stickers += await app.get_custom_emoji_stickers(ids[:200])
-        ids = ids[200:]
+    for i in range(0, len(ids), 200):
+        stickers += await limiter.call('other', app.get_custom_emoji_stickers, ids[i:i + 200])
 
     # Download stickers
-    for id, s in zip(orig_ids, stickers):
+    async def dl(pair: tuple[int, Sticker]) -> Path:
+        eid, s = pair
         ext = guess_ext(app, FileId.decode(s.file_id).file_type, s.mime_type)
-        op = (await download_media(app, s, path / "emoji", f'{id}{ext}')).absolute().relative_to(path.absolute())
-
-        # Replace sticker paths
-        for r in results:
-            if "text" in r:
-                r['text'] = r['text'].replace(f'<i class="custom-emoji" emoji-src="emoji/{id}">',
-                                              f'<i class="custom-emoji" emoji-src="{op}">')
-
+        op = await download_media(app, s, path / "emoji", f'{eid}{ext}', store=media_store(export))
+        return op.absolute().relative_to(path.absolute())
+
+    pairs = list(zip(ids, stickers))
+    urls = dict(zip(ids, await gather_bounded(dl, pairs, int(export.get('max_concurrent_downloads', 4)))))
+
+    # Replace sticker paths, only in the results that use custom emojis, one pass each
+    def repl(m: re.Match) -> str:
+        op = urls.get(int(m[1]))
+        return f'<i class="custom-emoji" emoji-src="{op}">' if op else m[0]
+
+    affected = {id(r): r for rs in index.values() for r in rs}
+    for r in affected.values():
+        if "text" in r:
+            r['text'] = EMOJI_SRC_RE.sub(repl, r['text'])
+
+
+async def process_chat(chat_id: int, path: Path, export: dict, store: MessageStore, full: bool = False):
+    chat: Chat = await limiter.call('other', app.get_chat, chat_id)
+    log(f"&aChat obtained. Chat name: {chat.title} | Type: {chat.type} | ID: {chat.id}")
+
+    # Load the last crawl state, only messages after the high-water mark (minus a re-check window) are crawled
+    state = load_state(path)
+    if full:
+        state.last_id = 0
+    existing = load_posts(path) if state.last_id else []
+    if not existing:
+        state.last_id = 0
+    if state.last_id and not len(store):
+        log("> No local message store yet, it only keeps the messages crawled from now on (run tgc --full once to fill "
+            "it for tgc --rebuild)")
+    start_id = tail_start(existing, state.last_id - int(export.get('recheck_window', 200)) + 1)
+    if state.last_id:
+        log(f"> Incremental crawl from ID #{start_id} (last crawled ID #{state.last_id})")
+
+    # Find where the history ends, bots can't read it so they crawl until enough empty windows in a row
+    end_id = await latest_message_id(app, chat.id)
+    max_empty = int(export.get('max_empty_windows', 5))
+    if end_id is None:
+        log(f"> Latest message ID unknown, crawling until {max_empty} windows in a row are empty")
+
+    # Crawl 200 messages each request with several requests in flight, and process them as they arrive
+    log("Crawling channel posts...")
+    started = time.monotonic()
+    crawled = 0
+
+    async def crawl_messages() -> AsyncIterator[Message]:
+        nonlocal crawled
+        async for upto, window in fetch_windows(app, chat.id, start_id, int(export.get('crawl_depth', 4)), end_id,
+                                                max_empty):
+            crawled += len(window)
+            if end_id:
+                done = (upto - start_id + 1) / (end_id - start_id + 1)
+                eta = (time.monotonic() - started) * (1 - done) / done
+                log(f"> {crawled} total messages... (up to ID #{upto}, {done:.0%}, ETA {eta:.0f}s)")
+            else:
+                log(f"> {crawled} total messages... (up to ID #{upto})")
+            for m in window:
+                yield m
+        log(f"> Crawled up to the latest message #{end_id}" if end_id is not None else
+            f"> {max_empty} windows of {WINDOW_SIZE} messages in a row are empty, we're done.")
+
+    # Raw messages go through a bounded queue, and are released as soon as they're converted to post records
+    concurrency = int(export.get('max_concurrent_downloads', 4))
+    thumbs = ThumbnailQueue(path / "media", media_store(export), export.get('thumb_max_size'))
+    ctx = ExportContext(path, export, state, ConversionQueue(executor), thumbs, store)
+    results = await stream_bounded(lambda m: process_message(m, ctx), crawl_messages(), concurrency, WINDOW_SIZE)
+    results.sort(key=lambda r: r['id'])
+    log(f"Processed {len(results)} messages")
+
+    # Thumbnails are downloaded while the media conversions finish
+    await asyncio.gather(ctx.conv.drain(), thumbs.download(app, concurrency))
+    await download_custom_emojis(ctx.emojis, path, export)
+
+    # Save the records before grouping, and forget the stored messages that are gone from the crawl window
+    ids = {r['id'] for r in results}
+    store.put_records(results)
+    store.prune(start_id, ids)
+
+    # Remember which post every album member went into, the crawl window is re-grouped from scratch
+    albums = {int(k): v for k, v in state.album_posts.items() if int(k) < start_id} | album_members(results)
+    state.album_posts = {str(k): v for k, v in albums.items()}
+
+    # Group messages, and merge them with the existing posts before the crawl window. Replies to older messages are
+    # resolved through the album members and the store.
+    results = merge_tail(existing, results, start_id,
+                         ReplyIndex([p for p in existing if p['id'] < start_id], store, albums))
+
+    write_posts(path, results, export.get('page_size'))
 
-async def process_chat(chat_id: int, path: Path, export: dict):
-    chat: Chat = await app.get_chat(chat_id)
-    printc(f"&aChat obtained. Chat name: {chat.title} | Type: {chat.type} | ID: {chat.id}")
-
-    # Crawl 200 messages each request
-    print("Crawling channel posts...")
-    msgs = []
-    for i in range(999):
-        start_idx = i * 200 + 1
-        end_idx = start_idx + 200
-
-        additional_msgs = await app.get_messages(chat.id, range(start_idx, end_idx))
-        additional_msgs = [m for m in additional_msgs if not m.empty]
-        msgs += additional_msgs
-        print(f"> {len(msgs)} total messages... (up to ID #{end_idx - 1})")
-
-        if not additional_msgs:
-            print("> All 200 messages are empty, we're done.")
-            break
-
-    # print(msgs)
-    results = [await process_message(m, path, export) for m in msgs]
-    await download_custom_emojis(msgs, results, path)
+    if 'rss' in export:
+        log("Exporting RSS feed...")
+        posts_to_feed(path, FeedMeta(**export['rss']), results)
 
-    # Group messages
-    results = group_msgs(results)
+    # A crawl from the start fills the store with the whole chat
+    if not state.last_id:
+        store.complete = True
+    store.commit()
+    state.last_id = max([state.last_id, *ids])
+    save_state(path, state)
 
-    write(path / "posts.json", json_stringify(results, indent=2))
-    write(path / "index.html", HTML.replace("$$POSTS_DATA$$", json_stringify(results)))
+    log(f"&aDone! Saved to {path} ({change_summary(path)})")
 
-    if 'rss' in export:
-        print("Exporting RSS feed...")
-        posts_to_feed(path, FeedMeta(**export['rss']))
 
-    printc(f"&aDone! Saved to {path / 'posts.json'}")
+async def process_export(export: dict, full: bool) -> bool:
+    """
+    Process one export, logging with its own prefix
 
+    :return: Whether it succeeded
+    """
+    path = Path(export["path"])
+    log_prefix.set(f"&7[{path.name}]&r ")
+    try:
+        store = MessageStore(message_store(export))
+        try:
+            await process_chat(int(export["chat_id"]), path, export, store, full)
+        finally:
+            store.close()
+        return True
+    except Exception as e:
+        log(f"&cFailed: {e!r}\n{traceback.format_exc()}")
+        return False
+
+
+def rebuild_export(export: dict) -> bool:
+    """
+    Regenerate every artifact of an export from its local message store, without connecting to Telegram
 
-async def run_app():
-    me: User = await app.get_me()
-    printc(f"&aLogin success! ID: {me.id} | is_bot: {me.is_bot}")
-    for export in cfg.exports:
-        await process_chat(int(export["chat_id"]), Path(export["path"]), export)
+    :return: Whether it succeeded
+    """
+    path = Path(export["path"])
+    log_prefix.set(f"&7[{path.name}]&r ")
+    store_dir = message_store(export)
+    if not (store_dir / STORE_FILE).is_file():
+        log(f"&cNo local message store in {store_dir}, run tgc to crawl it first")
+        return False
+
+    store = MessageStore(store_dir)
+    try:
+        if not store.complete:
+            log("&cThe local message store doesn't have every message, run tgc --full once to fill it")
+            return False
+
+        # Text is rendered again from the raw entities, with the custom emojis that are already downloaded
+        emojis = {f.stem: f'emoji/{f.name}' for f in sorted((path / "emoji").glob("*"))}
+
+        def repl(m: re.Match) -> str:
+            return f'<i class="custom-emoji" emoji-src="{emojis[m[1]]}">' if m[1] in emojis else m[0]
+
+        records = []
+        for raw, r in store.items():
+            if text := raw_text(raw):
+                r['text'] = EMOJI_SRC_RE.sub(repl, text)
+            else:
+                r.pop('text', None)
+            records.append(r)
+        log(f"Rebuilding from {len(records)} stored messages...")
+
+        posts = group_msgs(records)
+        write_posts(path, posts, export.get('page_size'))
+
+        if 'rss' in export:
+            log("Exporting RSS feed...")
+            posts_to_feed(path, FeedMeta(**export['rss']), posts)
+
+        log(f"&aDone! Saved to {path} ({change_summary(path)})")
+        return True
+    except Exception as e:
+        log(f"&cFailed: {e!r}\n{traceback.format_exc()}")
+        return False
+    finally:
+        store.close()
+
+
+async def run_app(full: bool = False):
+    me: User = await limiter.call('other', app.get_me)
+    log(f"&aLogin success! ID: {me.id} | is_bot: {me.is_bot}")
+
+    # Each export gets its own download pool, so a huge channel can't starve the others
+    ok = await gather_bounded(lambda e: process_export(e, full), cfg.exports, cfg.max_concurrent_exports)
+    log(f"&aRequests: {limiter.summary()}")
+
+    failed = [e['path'] for e, s in zip(cfg.exports, ok) if not s]
+    if failed:
+        log(f"&cFailed exports: {', '.join(failed)}")
+        exit(1)
 
 
 cfg: Config
 app: Client
+executor: ThreadPoolExecutor
 
 
 def run():
-    global app, cfg
+    global app, cfg, executor
     parser = argparse.ArgumentParser("Telegram Channel Message to Public API Crawler")
     parser.add_argument("config", help="Config path", nargs="?", default="config.toml")
+    parser.add_argument("--full", action="store_true", help="Ignore the last crawl state and re-crawl everything")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Regenerate every export from the local message store, without connecting to Telegram")
     args = parser.parse_args()
     cfg = load_config(args.config)
 
+    if args.rebuild:
+        failed = [e['path'] for e in cfg.exports if not rebuild_export(e)]
+        if failed:
+            log(f"&cFailed exports: {', '.join(failed)}")
+            exit(1)
+        return
+
+    limiter.configure(cfg.rate_limits or {})
+    executor = ThreadPoolExecutor(cfg.conversion_workers or os.cpu_count())
+
     app = Client("Bot", cfg.api_id or 2048, cfg.api_hash or "b18441a1ff607e10a989891a5462e627",
                  **(dict(bot_token=cfg.bot_token) if cfg.bot_token else {}))
 
     with app:
-        asyncio.get_event_loop().run_until_complete(run_app())
+        # Login and session setup sleep through flood waits with pyrogram's default threshold. From here on, they're
+        # raised instead, so that the shared rate limiter handles them.
+        app.sleep_threshold = 0
+        asyncio.get_event_loop().run_until_complete(run_app(args.full))
@@ -16,6 +16,8 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with Pyrogram.  If not, see <http://www.gnu.org/licenses/>.
 import asyncio
+import json
+import os
 import shutil
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -24,10 +26,13 @@ from typing import Callable, Any
 from hypy_utils import ensure_dir, md5
 from hypy_utils.file_utils import escape_filename
 from pyrogram import types, Client
-from pyrogram.errors import FloodWait
 from pyrogram.file_id import FileId, FileType, PHOTO_TYPES
 from pyrogram.types import Message
 
+from .log import log
+from .ratelimit import limiter
+from .scheduler import gather_bounded
+
 
 def guess_ext(client: Client, file_type: int, mime_type: str | None) -> str:
     guessed_extension = client.guess_extension(mime_type) if mime_type else None
@@ -104,6 +109,108 @@ def get_file_name(client: Client, message: Message) -> tuple[str, FileId]:
     return file_name, file_id_obj
 
 
+# Telegram serves files in 1 MB chunks, files larger than RESUMABLE_MIN_SIZE are downloaded resumably
+CHUNK_SIZE = 1024 * 1024
+RESUMABLE_MIN_SIZE = 20 * CHUNK_SIZE
+# Failed attempts in a row before a download is given up
+DOWNLOAD_RETRIES = 3
+
+# Locks of the content-addressed files being downloaded, so that the same file is only downloaded once
+_store_locks: dict[str, asyncio.Lock] = {}
+
+
+def link_file(src: Path, dst: Path):
+    """
+    Hardlink a file, or copy it if hardlinks aren't supported (e.g. across file systems)
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def is_complete(p: Path, fsize: int | None) -> bool:
+    """
+    Check if a file is downloaded completely (when the expected size is known)
+    """
+    return p.is_file() and (not fsize or p.stat().st_size == fsize)
+
+
+async def download_resumable(client: Client, message: types.Message, p: Path, fsize: int) -> Path:
+    """
+    Download a large file chunk by chunk into a .part file. The committed offset is journaled after every chunk, so
+    an interrupted download resumes where it left off. The file is only renamed to its final path after its size is
+    verified.
+
+    :param client: Client
+    :param message: Message or media
+    :param p: Final path
+    :param fsize: Expected file size
+    :return: Final path
+    """
+    part = p.with_name(p.name + '.part')
+    journal = p.with_name(p.name + '.part.json')
+
+    # Resume from the journaled offset, only if it's for the same file
+    offset = 0
+    if part.is_file() and journal.is_file():
+        try:
+            j = json.loads(journal.read_text())
+            if j['file_size'] == fsize and j['offset'] % CHUNK_SIZE == 0:
+                offset = min(j['offset'], part.stat().st_size)
+                offset -= offset % CHUNK_SIZE
+        except (ValueError, KeyError):
+            pass
+
+    if offset:
+        log(f"Resuming {p.name} from {offset / CHUNK_SIZE:.0f} MB...")
+    else:
+        log(f"Downloading {p.name} ({fsize / CHUNK_SIZE:.0f} MB)...")
+
+    with open(part, 'r+b' if part.is_file() else 'wb') as f:
+        f.truncate(offset)
+        f.seek(offset)
+
+        async def fetch_rest():
+            nonlocal offset
+            async for chunk in client.stream_media(message, offset=offset // CHUNK_SIZE):
+                f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+                offset += len(chunk)
+                journal.write_text(json.dumps({'file_size': fsize, 'offset': offset}))
+
+        # Pyrogram's get_file logs request errors (network drops, long flood waits) and ends the stream early instead
+        # of raising, so a short stream is resumed from the last committed chunk while the attempts make progress.
+        # Since the limiter never sees those flood waits, a short stream backs off the whole download pool.
+        stalled = 0
+        while offset < fsize and offset % CHUNK_SIZE == 0:
+            before = offset
+            await limiter.call('download', fetch_rest)
+            if offset >= fsize:
+                break
+            stalled = 0 if offset > before else stalled + 1
+            if stalled >= DOWNLOAD_RETRIES:
+                break
+            log(f"&eDownload of {p.name} ended early at {offset / CHUNK_SIZE:.0f} MB, retrying...")
+            limiter.back_off('download', 2 ** stalled)
+
+    if offset < fsize and offset % CHUNK_SIZE == 0:
+        # Keep the part file and its journal, the next run resumes from there
+        raise IOError(f"Download of {p.name} was interrupted at {offset / CHUNK_SIZE:.0f} of "
+                      f"{fsize / CHUNK_SIZE:.0f} MB, it will resume on the next run")
+
+    if offset != fsize:
+        # Not a prefix of the file (the size changed, or a chunk came back short), it can't be resumed
+        part.unlink()
+        journal.unlink(missing_ok=True)
+        raise IOError(f"Downloaded size of {p.name} doesn't match: {offset} != {fsize}")
+
+    os.replace(part, p)
+    journal.unlink(missing_ok=True)
+    return p
+
+
 async def download_media(
         client: Client,
         message: types.Message,
@@ -111,35 +218,72 @@ async def download_media(
         fname: str | None = None,
         progress: Callable = None,
         progress_args: tuple = (),
-        max_file_size: int = 0
-) -> Path | Path:
+        max_file_size: int = 0,
+        store: Path | None = None,
+        unique_id: str | None = None,
+        file_size: int = 0
+) -> Path | None:
+    """
+    Download media
+
+    :param store: Content-addressed media store. If set, files are downloaded into the store (keyed on Telegram's
+        file_unique_id) and hardlinked into the directory, so files shared between messages and exports are only
+        downloaded once
+    :param unique_id: File unique id, if the message is a file id string
+    :param file_size: Expected file size, if the message is a file id string
+    :return: Downloaded path, or None if skipped
+    """
     directory: Path = ensure_dir(directory)
 
     media = has_media(message)
 
     # Check filesize
-    fsize = getattr(media, 'file_size', 0)
+    fsize = getattr(media, 'file_size', 0) or file_size
     if max_file_size and fsize > max_file_size:
-        print(f"Skipped {fname} because of file size limit ({fsize} > {max_file_size})")
+        log(f"Skipped {fname} because of file size limit ({fsize} > {max_file_size})")
         return None
 
     file_name, file_id_obj = get_file_name(client, message)
     file_name = fname or file_name
 
     p = directory / file_name
-    if p.exists():
+    if is_complete(p, fsize):
         return p
 
-    print(f"Downloading {p.name}...")
+    unique_id = unique_id or getattr(media, 'file_unique_id', None)
+    if store and unique_id:
+        sp = Path(store) / unique_id[:2] / (unique_id + p.suffix)
+        async with _store_locks.setdefault(unique_id, asyncio.Lock()):
+            if not is_complete(sp, fsize):
+                await download_media(client, message, sp.parent, sp.name, progress, progress_args,
+                                     file_size=file_size)
+            _store_locks.pop(unique_id, None)
+        p.unlink(missing_ok=True)
+        link_file(sp, p)
+        return p
 
-    while True:
-        try:
-            return Path(await client.handle_download(
-                (file_id_obj, directory, file_name, False, fsize, progress, progress_args)
-            ))
-        except FloodWait as e:
-            print(f"Sleeping for {e.value} seconds...")
-            await asyncio.sleep(e.value)
+    if fsize and fsize >= RESUMABLE_MIN_SIZE:
+        return await download_resumable(client, message, p, fsize)
+
+    log(f"Downloading {p.name}...")
+
+    # Pyrogram's get_file logs request errors and ends the stream instead of raising, so a failed download comes back
+    # as a truncated file (or None, if handle_download itself fails). Only a file of the expected size is accepted.
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        fp = await limiter.call('download', client.handle_download,
+                                (file_id_obj, directory, file_name, False, fsize, progress, progress_args))
+        if fp is not None and is_complete(Path(fp), fsize):
+            return Path(fp)
+
+        # Never keep a truncated file, it would be taken as complete by later runs (and linked from the media store)
+        if fp is not None:
+            Path(fp).unlink(missing_ok=True)
+        if attempt < DOWNLOAD_RETRIES:
+            log(f"&eDownload of {p.name} failed, retrying ({attempt}/{DOWNLOAD_RETRIES})...")
+            # Likely a flood wait that get_file swallowed, so the whole download pool backs off
+            limiter.back_off('download', 2 ** attempt)
+
+    raise IOError(f"Failed to download {p.name} after {DOWNLOAD_RETRIES} attempts")
 
 
 async def download_media_urlsafe(
@@ -149,7 +293,8 @@ async def download_media_urlsafe(
         fname: str | None = None,
         progress: Callable = None,
         progress_args: tuple = (),
-        max_file_size: int = 0
+        max_file_size: int = 0,
+        store: Path | None = None
 ) -> tuple[Path, str]:
     """
     Download media into a renamed file
@@ -158,4 +303,76 @@ async def download_media_urlsafe(
     """
     file_name, file_id_obj = get_file_name(client, message)
     renamed = str(message.id) + Path(file_name).suffix
-    return await download_media(client, message, directory, renamed, progress, progress_args, max_file_size), file_name
+    return await download_media(client, message, directory, renamed, progress, progress_args, max_file_size,
+                                store), file_name
+
+
+def pick_thumb(thumbs: list[dict], max_size: int | None = None) -> dict:
+    """
+    Pick the largest thumbnail that fits in max_size, or the smallest one if none of them fit
+
+    >>> ts = [{'width': 90, 'height': 60, 'file_size': 1}, {'width': 320, 'height': 240, 'file_size': 9}]
+    >>> pick_thumb(ts)['width'], pick_thumb(ts, 100)['width'], pick_thumb(ts, 50)['width']
+    (320, 90, 90)
+
+    :param thumbs: Thumbnails of a file
+    :param max_size: Max width/height in pixels
+    :return: Thumbnail
+    """
+    def fits(t: dict) -> bool:
+        return not max_size or max(t.get('width') or 0, t.get('height') or 0) <= max_size
+
+    def size(t: dict) -> int:
+        return t.get('file_size') or 0
+
+    candidates = [t for t in thumbs if fits(t)]
+    return max(candidates, key=size) if candidates else min(thumbs, key=size)
+
+
+class ThumbnailQueue:
+    """
+    Queue of thumbnail downloads
+
+    Thumbnails are collected while the primary media downloads, and fetched afterwards in their own stage so that
+    hundreds of small round-trips don't hold up the media downloads. Each thumbnail is only downloaded once per
+    file_unique_id, since forwarded messages share the same thumbnails.
+    """
+    def __init__(self, directory: Path, store: Path | None = None, max_size: int | None = None):
+        self.directory = directory
+        self.store = store
+        self.max_size = max_size
+        self.jobs: dict[str, tuple[dict, str, list[Callable[[Path], None]]]] = {}
+
+    def add(self, thumbs: list[dict], fname: str, then: Callable[[Path], None]):
+        """
+        Queue the thumbnail of a file
+
+        :param thumbs: Thumbnails of the file
+        :param fname: Thumbnail file name without the extension
+        :param then: Callback to apply the downloaded path
+        """
+        thumb = pick_thumb(thumbs, self.max_size)
+        key = thumb.get('file_unique_id') or thumb['file_id']
+        # Thumbnails are always photos, so they're always jpg
+        self.jobs.setdefault(key, (thumb, fname + '.jpg', []))[2].append(then)
+
+    async def download(self, client: Client, limit: int):
+        """
+        Download every queued thumbnail
+
+        :param client: Client
+        :param limit: Max concurrent downloads
+        """
+        jobs, self.jobs = self.jobs, {}
+        if not jobs:
+            return
+        log(f"Downloading {len(jobs)} thumbnails...")
+
+        async def dl(job: tuple[dict, str, list[Callable[[Path], None]]]):
+            thumb, fname, thens = job
+            fp = await download_media(client, thumb['file_id'], self.directory, fname, store=self.store,
+                                      unique_id=thumb.get('file_unique_id'), file_size=thumb.get('file_size') or 0)
+            for then in thens:
+                then(fp)
+
+        await gather_bounded(dl, jobs.values(), limit)
@@ -1,37 +1,65 @@
+from typing import Mapping
+
 from hypy_utils.dict_utils import remove_nones
 
 
-def group_msgs(msgs: list[dict]) -> list[dict]:
+def _dominant(grp: list[dict]) -> dict:
+    """
+    Find the message of a media group that is kept as its grouped post: the first one with text
+    """
+    return next((a for a in grp if 'text' in a), grp[0])
+
+
+def album_members(msgs: list[dict]) -> dict[int, int]:
+    """
+    Map the ID of every media group member that doesn't become a post to the ID of its grouped post
+
+    >>> album_members([{'id': 3, 'media_group_id': 5, 'text': 'a'}, {'id': 2, 'media_group_id': 5}, {'id': 4}])
+    {2: 3}
+
+    :param msgs: Messages (not grouped)
+    :return: Member ID to post ID
+    """
+    groups: dict[int, list[dict]] = {}
+    for m in sorted(msgs, key=lambda x: x['id']):
+        if 'media_group_id' in m:
+            groups.setdefault(m['media_group_id'], []).append(m)
+
+    members = {}
+    for grp in groups.values():
+        m = _dominant(grp)
+        members.update({a['id']: m['id'] for a in grp if a is not m})
+    return members
+
+
+def group_msgs(msgs: list[dict], known: Mapping[int, dict] | None = None) -> list[dict]:
     """
     Merge message files into groups
 
     Conditions: Messages will be sorted by increasing ID (with the oldest message on top)
 
     :param msgs: Messages
+    :param known: Already grouped posts by ID, used to resolve replies to messages outside of msgs
     :return: Messages with file groups
     """
+    known = {} if known is None else known
+
     # Sort messages
     msgs = sorted(msgs, key=lambda x: x['id'])
 
-    # Find groups
+    # Find groups in one pass
     id_map = {m['id']: m for m in msgs}
-    tmp_grouped: list[dict] = [d for d in msgs if 'media_group_id' in d]
-    gids: set[int] = {d['media_group_id'] for d in tmp_grouped}
-    groups: dict[int, list[dict]] = {g: [d for d in tmp_grouped if d['media_group_id'] == g] for g in gids}
+    groups: dict[int, list[dict]] = {}
+    for m in msgs:
+        if 'media_group_id' in m:
+            groups.setdefault(m['media_group_id'], []).append(m)
 
     # Group messages
-    result = []
+    dominant_ids: set[int] = set()
     reply_map: dict[int, dict] = {}
-    for gid, grp in groups.items():
-        # Loop through each message, find the first message with text
-        def find_dominant():
-            for m in grp:
-                if 'text' in m:
-                    return m
-            return grp[0]
-
-        m = find_dominant()
-        result.append(m)
+    for grp in groups.values():
+        m = _dominant(grp)
+        dominant_ids.add(m['id'])
         reply_map.update({a['id']: m for a in grp})
 
         # Group files & images into a list
@@ -51,22 +79,68 @@ def group_msgs(msgs: list[dict]) -> list[dict]:
         if 'reply_id' not in m:
             continue
         rid = m.pop('reply_id')
-        rm = reply_map.get(rid) or id_map[rid]
+        rm = reply_map.get(rid) or id_map.get(rid) or known.get(rid)
+        if rm is None:
+            continue
 
-        m['reply'] = {
+        # Ungrouped messages of msgs don't have their file lists yet
+        media = rm.get('files') or rm.get('images') or [rm.get('file') or rm.get('image')]
+        m['reply'] = remove_nones({
             'id': rm['id'],
             'text': rm.get('text'),
-            'thumb': ((rm.get('files') or rm.get('images') or [None])[0] or {}).get('thumb')
-        }
+            'thumb': (media[0] or {}).get('thumb')
+        })
 
-    # Add non-grouped messages to results
-    grouped_ids = {m['id'] for v in groups.values() for m in v}
-    ungrouped = [m for m in msgs if m['id'] not in grouped_ids]
-    for m in ungrouped:
+    # Keep the dominant message of each group and all non-grouped messages, already in ID order
+    result = []
+    for m in msgs:
+        if m['id'] in reply_map:
+            if m['id'] in dominant_ids:
+                result.append(m)
+            continue
         if 'file' in m:
             m['files'] = [m.pop('file')]
         if 'image' in m:
-            m['images'] = [m.pop('image')] or None
-    result += ungrouped
+            m['images'] = [m.pop('image')]
+        result.append(m)
+
+    return result
+
+
+def tail_start(posts: list[dict], start_id: int) -> int:
+    """
+    Find the first message ID of the tail to re-group, so that no media group is split between the already grouped
+    posts and the tail. A media group of k files is a run of consecutive messages, so it lies within k - 1 IDs of
+    its grouped post.
+
+    >>> album = {'media_group_id': 1, 'images': [{}, {}, {}]}
+    >>> tail_start([{'id': 8} | album], 10), tail_start([{'id': 7} | album], 10), tail_start([{'id': 11} | album], 10)
+    (6, 10, 9)
+
+    :param posts: Already grouped posts
+    :param start_id: Desired start ID
+    :return: Adjusted start ID
+    """
+    grouped = sorted(((p['id'], len(p.get('files') or []) + len(p.get('images') or []))
+                      for p in posts if 'media_group_id' in p), reverse=True)
+    for pid, k in grouped:
+        if pid < start_id - 10:
+            break
+        if pid - (k - 1) < start_id <= pid + (k - 1):
+            start_id = pid - (k - 1)
+    return max(start_id, 1)
 
-    return sorted(remove_nones(result), key=lambda x: x['id'])
+
+def merge_tail(posts: list[dict], tail: list[dict], start_id: int,
+               known: Mapping[int, dict] | None = None) -> list[dict]:
+    """
+    Group only the newly crawled tail and merge it into the already grouped posts
+
+    :param posts: Already grouped posts
+    :param tail: New (not grouped) messages, all with ID >= start_id (see tail_start)
+    :param start_id: Start ID of the tail, grouped posts from this ID on are replaced
+    :param known: Reply targets outside of the tail (defaults to the kept posts)
+    :return: Merged posts
+    """
+    kept = [p for p in posts if p['id'] < start_id]
+    return kept + group_msgs(tail, known if known is not None else {p['id']: p for p in kept})
@@ -0,0 +1,82 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterator
+
+from pyrogram import Client
+from pyrogram.errors import BotMethodInvalid
+from pyrogram.types import Message
+
+from .ratelimit import limiter
+
+# Number of message IDs requested in each get_messages call (the API maximum)
+WINDOW_SIZE = 200
+
+
+async def latest_message_id(client: Client, chat_id: int) -> int | None:
+    """
+    Get the ID of the newest message in a chat
+
+    :param client: Client
+    :param chat_id: Chat ID
+    :return: Newest message ID (0 if the chat is empty), or None if it can't be read (bots can't read chat history)
+    """
+    async def newest() -> int:
+        async for m in client.get_chat_history(chat_id, limit=1):
+            return m.id
+        return 0
+
+    try:
+        return await limiter.call('messages', newest)
+    except BotMethodInvalid:
+        return None
+
+
+async def fetch_windows(client: Client, chat_id: int, start_id: int, depth: int = 4, end_id: int | None = None,
+                        max_empty: int = 5) -> AsyncIterator[tuple[int, list[Message]]]:
+    """
+    Fetch the message history of a chat in windows of WINDOW_SIZE IDs, keeping `depth` windows in flight
+
+    Windows are yielded in ID order as soon as every window before them has arrived. If the newest message ID is
+    known, exactly the windows up to it are fetched, and empty windows (e.g. deleted posts) are skipped over.
+    Otherwise, fetching stops after `max_empty` empty windows in a row, and the windows requested after them are
+    cancelled. Flood waits are handled by the shared rate limiter.
+
+    :param client: Client
+    :param chat_id: Chat ID
+    :param start_id: First message ID to fetch
+    :param depth: Number of windows requested at the same time
+    :param end_id: Newest message ID, if known
+    :param max_empty: Number of empty windows in a row that end the history, if end_id isn't known
+    :return: Last ID of each window, and its non-empty messages
+    """
+    async def fetch(start: int) -> list[Message]:
+        end = start + WINDOW_SIZE if end_id is None else min(start + WINDOW_SIZE, end_id + 1)
+        return await limiter.call('messages', client.get_messages, chat_id, range(start, end))
+
+    pending: deque[tuple[int, asyncio.Task]] = deque()
+    next_start = start_id
+
+    def schedule():
+        nonlocal next_start
+        if end_id is not None and next_start > end_id:
+            return
+        pending.append((next_start, asyncio.ensure_future(fetch(next_start))))
+        next_start += WINDOW_SIZE
+
+    for _ in range(max(depth, 1)):
+        schedule()
+
+    empty = 0
+    try:
+        while pending:
+            start, task = pending.popleft()
+            msgs = [m for m in await task if not m.empty]
+            empty = 0 if msgs else empty + 1
+            if end_id is None and empty >= max_empty:
+                return
+            schedule()
+            last = start + WINDOW_SIZE - 1
+            yield last if end_id is None else min(last, end_id), msgs
+    finally:
+        for _, t in pending:
+            t.cancel()
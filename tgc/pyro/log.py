@@ -0,0 +1,10 @@
+from contextvars import ContextVar
+
+from hypy_utils import printc
+
+# Prefix of the export being processed in the current task, so that logs of concurrent exports can be told apart
+log_prefix: ContextVar[str] = ContextVar('log_prefix', default='')
+
+
+def log(msg: str):
+    printc(log_prefix.get() + msg)
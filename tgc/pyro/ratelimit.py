@@ -0,0 +1,126 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Awaitable, TypeVar
+
+from pyrogram.errors import FloodWait
+
+from .log import log
+from .scheduler import FloodGate
+
+R = TypeVar('R')
+
+# Default (requests per second, burst) for each class of MTProto methods
+DEFAULT_RATES: dict[str, tuple[float, float]] = {
+    'messages': (5, 10),
+    'download': (20, 20),
+    'other': (5, 5),
+}
+
+
+@dataclass
+class TokenBucket:
+    base_rate: float
+    burst: float
+    rate: float = 0
+    tokens: float = 0
+    updated: float = field(default_factory=time.monotonic)
+
+    # Counters
+    calls: int = 0
+    flood_waits: int = 0
+    flood_seconds: float = 0
+    back_offs: int = 0
+
+    def __post_init__(self):
+        self.rate = self.rate or self.base_rate
+        self.tokens = self.tokens or self.burst
+        # asyncio locks are fair, so tokens are handed out in request order
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def slow_down(self):
+        """
+        Halve the request rate after a flood wait
+        """
+        self.rate = max(self.base_rate / 16, self.rate / 2)
+        self.tokens = 0
+
+    def speed_up(self):
+        """
+        Slowly recover the request rate after a successful request
+        """
+        self.rate = min(self.base_rate, self.rate * 1.02)
+
+
+class RateLimiter:
+    """
+    Central rate limiter that every MTProto call goes through.
+
+    Each method class has its own token bucket, while flood waits are shared: a FloodWait from any call pauses
+    every call until the deadline passes, and slows down the bucket of the method class that caused it.
+    """
+    def __init__(self, rates: dict[str, tuple[float, float]] = None):
+        self.gate = FloodGate()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.configure(rates or {})
+
+    def configure(self, rates: dict[str, tuple[float, float] | list[float]]):
+        for kind, (rate, burst) in (DEFAULT_RATES | rates).items():
+            self.buckets[kind] = TokenBucket(float(rate), float(burst))
+
+    async def call(self, kind: str, fn: Callable[..., Awaitable[R]], *args, **kwargs) -> R:
+        """
+        Call an MTProto method, retrying on flood waits
+
+        :param kind: Method class (a key of DEFAULT_RATES)
+        :param fn: Async client method
+        :return: Result of the method
+        """
+        bucket = self.buckets[kind]
+        while True:
+            await self.gate.wait()
+            await bucket.acquire()
+            bucket.calls += 1
+            try:
+                result = await fn(*args, **kwargs)
+                bucket.speed_up()
+                return result
+            except FloodWait as e:
+                log(f"Flood wait on {kind}, sleeping for {e.value} seconds...")
+                bucket.flood_waits += 1
+                bucket.flood_seconds += e.value
+                bucket.slow_down()
+                self.gate.pause(e.value)
+
+    def back_off(self, kind: str, seconds: float):
+        """
+        Pause every call and slow down a method class after a failure that pyrogram swallows instead of raising a
+        FloodWait (e.g. downloads, which get_file ends early on long flood waits and request errors)
+
+        :param kind: Method class
+        :param seconds: Pause duration
+        """
+        bucket = self.buckets[kind]
+        bucket.back_offs += 1
+        bucket.slow_down()
+        self.gate.pause(seconds)
+
+    def summary(self) -> str:
+        return " | ".join(f"{k}: {b.calls} calls, {b.flood_waits} flood waits ({b.flood_seconds:.0f}s)"
+                          + (f", {b.back_offs} back-offs" if b.back_offs else "")
+                          for k, b in self.buckets.items() if b.calls)
+
+
+# Shared by the whole crawler
+limiter = RateLimiter()
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from typing import Callable, Awaitable, Iterable, AsyncIterable, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class FloodGate:
+    """
+    Shared FloodWait back-off. When any worker hits a flood wait, every worker waiting on the gate is paused
+    until the deadline passes, instead of each task sleeping on its own.
+    """
+    until: float = 0
+
+    def pause(self, seconds: float):
+        self.until = max(self.until, time.monotonic() + seconds)
+
+    async def wait(self):
+        while (delay := self.until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+
+async def gather_bounded(fn: Callable[[T], Awaitable[R]], items: Iterable[T], limit: int) -> list[R]:
+    """
+    Run fn on every item with at most `limit` calls running at the same time
+
+    :param fn: Async function
+    :param items: Items
+    :param limit: Max concurrency
+    :return: Results in the same order as the items
+    """
+    sem = asyncio.Semaphore(max(limit, 1))
+
+    async def worker(it: T) -> R:
+        async with sem:
+            return await fn(it)
+
+    return list(await asyncio.gather(*(worker(it) for it in items)))
+
+
+async def stream_bounded(fn: Callable[[T], Awaitable[R]], source: AsyncIterable[T], limit: int,
+                         buffer: int) -> list[R]:
+    """
+    Run fn on every item of an async source with at most `limit` calls running at the same time
+
+    The source is read at most `buffer` items ahead of the workers, so only the items in flight are held in memory.
+
+    :param fn: Async function
+    :param source: Async iterable of items
+    :param limit: Max concurrency
+    :param buffer: Max number of items read ahead
+    :return: Results in completion order
+    """
+    limit = max(limit, 1)
+    queue: asyncio.Queue = asyncio.Queue(max(buffer, 1))
+    done = object()
+    results = []
+
+    async def produce():
+        async for it in source:
+            await queue.put(it)
+        for _ in range(limit):
+            await queue.put(done)
+
+    async def worker():
+        while (it := await queue.get()) is not done:
+            results.append(await fn(it))
+
+    # Cancel the rest of the pipeline if any stage fails
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(worker()) for _ in range(limit)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+    return results
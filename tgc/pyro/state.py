@@ -0,0 +1,54 @@
+import json
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+from hypy_utils import json_stringify
+
+from .log import log
+from ..output import write_atomic
+
+# Bump this when the crawl output changes in a way that requires a full re-crawl
+STATE_VERSION = 2
+STATE_FILE = "crawl_state.json"
+
+
+@dataclass
+class CrawlState:
+    version: int = STATE_VERSION
+    last_id: int = 0
+    last_run: str | None = None
+    # Image dimensions by url, so that re-runs don't need to read image files again
+    image_sizes: dict[str, list[int]] = field(default_factory=dict)
+    # Grouped post ID of every media group member that isn't a post itself (keys are IDs as strings, like in JSON), so
+    # that incremental crawls can resolve replies to album members without the message store
+    album_posts: dict[str, int] = field(default_factory=dict)
+
+
+def load_state(path: Path) -> CrawlState:
+    """
+    Load the crawl state of an export
+
+    :param path: Export path
+    :return: Crawl state, or an empty state if there isn't a valid one (which triggers a full crawl)
+    """
+    fp = path / STATE_FILE
+    if not fp.is_file():
+        return CrawlState()
+
+    try:
+        state = CrawlState(**json.loads(fp.read_text()))
+    except (ValueError, TypeError) as e:
+        log(f"&e> Crawl state is invalid ({e!r}), doing a full crawl.")
+        return CrawlState()
+
+    if state.version != STATE_VERSION:
+        log(f"> Crawl state version changed ({state.version} -> {STATE_VERSION}), doing a full crawl.")
+        return CrawlState()
+
+    return state
+
+
+def save_state(path: Path, state: CrawlState):
+    state.last_run = datetime.now(timezone.utc).isoformat()
+    write_atomic(path / STATE_FILE, json_stringify(asdict(state), indent=2), artifact=False)
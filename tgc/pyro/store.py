@@ -0,0 +1,109 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Iterable, Iterator, Mapping
+
+from hypy_utils import json_stringify, ensure_dir
+from pyrogram.types import Message
+from pyrogram.types.object import Object
+
+STORE_FILE = "messages.db"
+# Base directory of the message stores, outside of the export directories that are usually served or committed
+DEFAULT_STORE_DIR = Path.home() / ".cache" / "tgc" / "messages"
+
+
+class MessageStore:
+    """
+    Local SQLite store of the crawled messages of an export, keyed by message ID
+
+    Each row keeps the raw message (pyrogram's JSON of it) and its post record before grouping, so that every
+    artifact can be rebuilt without asking Telegram again (see `tgc --rebuild`). Changes are written during the
+    crawl, and only committed when the crawl finishes. The store is kept outside of the export directory (see
+    DEFAULT_STORE_DIR), since it holds the full data of every message.
+    """
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(ensure_dir(path) / STORE_FILE)
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, raw TEXT NOT NULL, record TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether the store has every message of the chat (it was filled by a full crawl), which rebuilds need
+        """
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        return bool(row and json.loads(row[0]))
+
+    @complete.setter
+    def complete(self, value: bool):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', ?)", (json.dumps(value),))
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def put_raw(self, msg: Message):
+        raw = json.dumps(msg, default=Object.default, ensure_ascii=False)
+        self.db.execute("INSERT INTO messages (id, raw) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET raw = excluded.raw",
+                        (msg.id, raw))
+
+    def put_records(self, records: Iterable[dict]):
+        """
+        Save the post records (before grouping) of messages whose raw data is already stored
+        """
+        self.db.executemany("UPDATE messages SET record = ? WHERE id = ?",
+                            ((json_stringify(r), r['id']) for r in records))
+
+    def prune(self, start_id: int, keep: set[int]):
+        """
+        Delete the messages from start_id on that weren't crawled again (e.g. deleted posts)
+        """
+        ids = [i for (i,) in self.db.execute("SELECT id FROM messages WHERE id >= ?", (start_id,)) if i not in keep]
+        self.db.executemany("DELETE FROM messages WHERE id = ?", ((i,) for i in ids))
+
+    def record(self, mid: int) -> dict | None:
+        row = self.db.execute("SELECT record FROM messages WHERE id = ?", (mid,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def items(self) -> Iterator[tuple[dict, dict]]:
+        """
+        Iterate over the stored messages in ID order
+
+        :return: Raw message and post record of each message
+        """
+        for raw, record in self.db.execute("SELECT raw, record FROM messages WHERE record IS NOT NULL ORDER BY id"):
+            yield json.loads(raw), json.loads(record)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class ReplyIndex(Mapping[int, dict]):
+    """
+    Reply targets outside of the re-grouped messages: the already grouped posts (album members resolve to their
+    grouped post), then any message in the store. Stored messages of a media group resolve to the grouped post of
+    their group.
+    """
+    def __init__(self, posts: list[dict], store: MessageStore, albums: Mapping[int, int] | None = None):
+        self.posts = {p['id']: p for p in posts}
+        self.groups = {p['media_group_id']: p for p in posts if 'media_group_id' in p}
+        self.store = store
+        self.albums = albums or {}
+
+    def __getitem__(self, mid: int) -> dict:
+        if mid in self.posts:
+            return self.posts[mid]
+        if self.albums.get(mid) in self.posts:
+            return self.posts[self.albums[mid]]
+        r = self.store.record(mid)
+        if r is None:
+            raise KeyError(mid)
+        return self.groups.get(r.get('media_group_id'), r)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.posts)
+
+    def __len__(self) -> int:
+        return len(self.posts)
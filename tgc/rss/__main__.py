@@ -17,6 +17,7 @@ if __name__ == '__main__':
     parser.add_argument('--description', help='Feed description')
     parser.add_argument('--language', help='Feed language')
     parser.add_argument('--image-url', help='Feed image URL')
+    parser.add_argument('--max-entries', type=int, help='Only include the latest N posts')
 
     # Supply meta info through config file
     parser.add_argument('-c', '--config', help='Path to rss.toml file')
@@ -33,7 +34,8 @@ if __name__ == '__main__':
         link=args.link,
         description=args.description,
         language=args.language,
-        image_url=args.image_url
+        image_url=args.image_url,
+        max_entries=args.max_entries
     )
 
     # Load meta info from rss.toml
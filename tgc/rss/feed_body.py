@@ -0,0 +1,87 @@
+import html
+import re
+from urllib.parse import urljoin
+
+# Bump this when the rendered output changes, to invalidate cached entries
+RENDERER_VERSION = 1
+
+CUSTOM_EMOJI_RE = re.compile(r'<i class="custom-emoji" emoji-src="([^"]*)">(.*?)</i>', re.S)
+PRE_RE = re.compile(r'(<pre(?: language="([^"]*)")?>.*?</pre>)', re.S)
+
+
+def abs_url(base: str, url: str) -> str:
+    return urljoin(base.rstrip('/') + '/', str(url))
+
+
+def render_text(text: str, base: str) -> str:
+    """
+    Render the HTML text of a post (from convert_text) for feed readers
+
+    * Custom emojis become inline images with absolute URLs (falling back to their emoji text)
+    * <pre language="x"> blocks become <pre><code class="language-x">
+    * Line breaks outside of <pre> blocks become <br>
+
+    >>> render_text('a <i class="custom-emoji" emoji-src="emoji/1.webp">😀</i>\\nb', 'https://example.com/data')
+    'a <img src="https://example.com/data/emoji/1.webp" alt="😀" style="height: 1.2em"><br>\\nb'
+    >>> render_text('<pre language="py">x\\ny</pre>', 'https://example.com')
+    '<pre><code class="language-py">x\\ny</code></pre>'
+    """
+    def emoji(m: re.Match) -> str:
+        src, alt = m[1], m[2]
+        if not src or src.startswith('('):
+            return alt
+        return f'<img src="{html.escape(abs_url(base, src))}" alt="{html.escape(alt)}" style="height: 1.2em">'
+
+    text = CUSTOM_EMOJI_RE.sub(emoji, text)
+
+    out = []
+    for i, part in enumerate(PRE_RE.split(text)):
+        # split() returns [text, pre block, language, text, ...]
+        match i % 3:
+            case 0:
+                out.append(part.replace('\n', '<br>\n'))
+            case 1:
+                lang = PRE_RE.match(part)[2]
+                inner = part[part.index('>') + 1:-len('</pre>')]
+                cls = f' class="language-{html.escape(lang)}"' if lang else ''
+                out.append(f'<pre><code{cls}>{inner}</code></pre>')
+    return ''.join(out)
+
+
+def render_media(post: dict, base: str) -> str:
+    """
+    Render the images and files of a post as HTML with absolute URLs
+    """
+    out = []
+    for img in post.get('images') or []:
+        out.append(f'<img src="{html.escape(abs_url(base, img["url"]))}">')
+    for f in post.get('files') or []:
+        url = html.escape(abs_url(base, f['url']))
+        if f.get('thumb'):
+            out.append(f'<img src="{html.escape(abs_url(base, f["thumb"]))}">')
+        out.append(f'<a href="{url}">{html.escape(f.get("original_name") or f["url"].split("/")[-1])}</a>')
+    return '<br>\n'.join(out)
+
+
+def render_body(post: dict, base: str) -> str:
+    """
+    Render the feed entry body of a post from its structured data
+
+    :param post: Post
+    :param base: Base URL that the export directory is served from
+    :return: HTML body
+    """
+    parts = [render_text(post.get('text') or post.get('caption') or '', base), render_media(post, base)]
+    return '<br>\n'.join(p for p in parts if p)
+
+
+def enclosure(post: dict, base: str) -> tuple[str, str, str] | None:
+    """
+    Get the enclosure (url, length, type) of a post, which is its first image or file
+    """
+    media = (post.get('images') or []) + (post.get('files') or [])
+    if not media:
+        return None
+    m = media[0]
+    default_type = 'image/jpeg' if post.get('images') else 'application/octet-stream'
+    return abs_url(base, m['url']), str(m.get('size') or 0), m.get('mime_type') or default_type
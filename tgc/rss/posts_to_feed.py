@@ -1,11 +1,18 @@
+import hashlib
 import json
 from dataclasses import dataclass
-from datetime import timezone
+from datetime import timezone, datetime
 from pathlib import Path
 
 from dateutil import parser
 from feedgen.feed import FeedGenerator
-from markdown import markdown
+from hypy_utils import write, json_stringify
+
+from .feed_body import render_body, enclosure, RENDERER_VERSION
+from ..output import load_posts, write_atomic
+from ..pyro.log import log
+
+CACHE_FILE = "feed_cache.json"
 
 
 @dataclass
@@ -15,14 +22,41 @@ class FeedMeta:
     description: str
     language: str
     image_url: str
+    max_entries: int | None = None
+    media_url: str | None = None  # Base URL of the export directory, defaults to link
+
+
+def post_date(post: dict) -> datetime:
+    """
+    Get the date of a post (which is a datetime if the post is freshly crawled, or a string if loaded from json)
+    """
+    date = post['date']
+    if not isinstance(date, datetime):
+        try:
+            date = datetime.fromisoformat(date)
+        except ValueError:
+            date = parser.parse(date)
+    return date.replace(tzinfo=timezone.utc)
 
 
-def posts_to_feed(path: Path, meta: FeedMeta):
+def entry_hash(post: dict, base: str) -> str:
+    """
+    Hash of everything that the rendered entry of a post depends on
+    """
+    data = [RENDERER_VERSION, base, post.get('text') or post.get('caption'), post.get('images'), post.get('files')]
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def posts_to_feed(path: Path, meta: FeedMeta, posts: list[dict] | None = None):
     """
     Convert posts to RSS feed. This function will create the rss feed in the same directory as posts.json
 
-    :param path: Path to the parent directory that contains posts.json
+    Rendered entries are cached in feed_cache.json (keyed by post ID and a hash of the post content), so only new
+    or edited posts are rendered again.
+
+    :param path: Path to the parent directory that contains posts.json (or the paged posts)
     :param meta: Feed meta info
+    :param posts: Posts, if they're already loaded
     """
     fg = FeedGenerator()
     
@@ -34,20 +68,45 @@ def posts_to_feed(path: Path, meta: FeedMeta):
     fg.language(meta.language)
     fg.image(meta.image_url)
 
-    # Posts
-    posts = json.loads((path / 'posts.json').read_text())
+    # Posts, only the latest max_entries posts are included
+    posts = posts if posts is not None else load_posts(path)
+    posts = sorted(posts, key=lambda x: x['id'])
+    if meta.max_entries:
+        posts = posts[-meta.max_entries:]
+
+    # Load rendered bodies
+    cache_path = path / CACHE_FILE
+    cache: dict[str, dict] = json.loads(cache_path.read_text()) if cache_path.is_file() else {}
+    new_cache: dict[str, dict] = {}
+    rendered = 0
+    base = meta.media_url or meta.link
+
     for post in posts:
         fe = fg.add_entry()
         fe.id(str(post['id']))
         fe.title(f"{meta.title} #{post['id']}")
         fe.link(href=f'{meta.link}?post={post["id"]}')
-        fe.updated(parser.parse(post['date']).replace(tzinfo=timezone.utc))
+        fe.updated(post_date(post))
+
+        key = str(post['id'])
+        h = entry_hash(post, base)
+        entry = cache.get(key)
+        if not entry or entry['hash'] != h:
+            entry = {'hash': h, 'body': render_body(post, base), 'enclosure': enclosure(post, base)}
+            rendered += 1
+        new_cache[key] = entry
+        fe.description(entry['body'])
+        if entry['enclosure']:
+            fe.enclosure(*entry['enclosure'])
+
+    log(f"> Feed: {len(posts)} entries ({rendered} rendered)")
 
-        # Escape HTML tags
-        # text = html2text(markdown(post.get('text') or post.get('caption') or ''), bodywidth=0)
-        # text = html.escape(text.replace('\n', '<br>'))
-        text = markdown(post.get('text') or post.get('caption') or '')
-        fe.description(text)
+    # Use the latest post date as the build date, so that the feed only changes when the posts change
+    if posts:
+        latest = max(post_date(p) for p in posts)
+        fg.lastBuildDate(latest)
+        fg.updated(latest)
 
-    fg.rss_file(path / 'rss.xml', pretty=True)
-    fg.atom_file(path / 'atom.xml', pretty=True)
+    write_atomic(path / 'rss.xml', fg.rss_str(pretty=True).decode())
+    write_atomic(path / 'atom.xml', fg.atom_str(pretty=True).decode())
+    write(cache_path, json_stringify(new_cache))
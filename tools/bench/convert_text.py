@@ -0,0 +1,157 @@
+# Microbenchmark for tgc.pyro.convert.convert_text on long messages, checked against a golden corpus of outputs of
+# the previous implementation (convert_text_golden.json)
+# Usage: python -m tools.bench.convert_text [--update-golden]
+import argparse
+import json
+import random
+import timeit
+from pathlib import Path
+
+from pyrogram.enums import MessageEntityType
+from pyrogram.parser import utils
+from pyrogram.types import MessageEntity
+
+from tgc.pyro.convert import convert_text, entity_start_end
+
+TYPES = [MessageEntityType.BOLD, MessageEntityType.ITALIC, MessageEntityType.CODE, MessageEntityType.URL,
+         MessageEntityType.TEXT_LINK, MessageEntityType.CUSTOM_EMOJI, MessageEntityType.SPOILER]
+
+GOLDEN = Path(__file__).with_name("convert_text_golden.json")
+
+
+def legacy_convert_text(text: str, entities: list[MessageEntity]) -> str:
+    """
+    The previous implementation, which splices every tag into the whole text
+    """
+    text = utils.add_surrogates(text)
+    offsets = []
+    for entity in entities:
+        tags = entity_start_end(text, entity)
+        if tags is None:
+            continue
+        offsets.append((tags[0], entity.offset))
+        offsets.append((tags[1], entity.offset + entity.length))
+    for tag, offset in map(lambda x: x[1], sorted(enumerate(offsets), key=lambda x: (x[1][1], x[0]), reverse=True)):
+        text = text[:offset] + tag + text[offset:]
+    return utils.remove_surrogates(text)
+
+
+def entity(type: str, offset: int, length: int, **kw) -> MessageEntity:
+    return MessageEntity(type=MessageEntityType[type], offset=offset, length=length, **kw)
+
+
+def entity_dict(e: MessageEntity) -> dict:
+    d = {'type': e.type.name, 'offset': e.offset, 'length': e.length}
+    return d | {k: getattr(e, k) for k in ('url', 'language', 'custom_emoji_id') if getattr(e, k)}
+
+
+def golden_cases() -> list[tuple[str, list[MessageEntity]]]:
+    """
+    Hand-written edge cases, and random posts with emojis (surrogate pairs) and entities on character boundaries
+    """
+    cases = [
+        ("hello world", [entity('BOLD', 0, 5)]),
+        # Same start and end
+        ("hello world", [entity('BOLD', 0, 5), entity('ITALIC', 0, 5)]),
+        # Same start, different ends
+        ("hello world", [entity('BOLD', 0, 5), entity('ITALIC', 0, 11)]),
+        ("hello world", [entity('ITALIC', 0, 11), entity('BOLD', 0, 5), entity('UNDERLINE', 0, 3)]),
+        # Different starts, same end
+        ("hello world", [entity('BOLD', 0, 11), entity('ITALIC', 6, 5)]),
+        # Nested and overlapping
+        ("one two three", [entity('BOLD', 0, 13), entity('ITALIC', 4, 3)]),
+        ("one two three", [entity('BOLD', 0, 7), entity('ITALIC', 4, 9)]),
+        ("one two three", [entity('ITALIC', 4, 9), entity('BOLD', 0, 7)]),
+        # Adjacent, in and out of order
+        ("ab", [entity('BOLD', 0, 1), entity('CODE', 1, 1)]),
+        ("ab", [entity('CODE', 1, 1), entity('BOLD', 0, 1)]),
+        # Zero-length and unsupported entities
+        ("plain", [entity('BOLD', 2, 0)]),
+        ("plain", [entity('BOT_COMMAND', 0, 5)]),
+        ("/start now", [entity('BOT_COMMAND', 0, 6), entity('BOLD', 0, 6)]),
+        # Surrogate pairs before, inside and after entities
+        ("😀 @aza", [entity('MENTION', 3, 4)]),
+        ("a😀b", [entity('BOLD', 1, 2)]),
+        ("😀😀 x 😀", [entity('ITALIC', 0, 4), entity('BOLD', 2, 4), entity('CODE', 7, 2)]),
+        # Custom emojis
+        ("👍 great", [entity('CUSTOM_EMOJI', 0, 2, custom_emoji_id=5368324170671202286), entity('BOLD', 3, 5)]),
+        ("👍", [entity('BOLD', 0, 2), entity('CUSTOM_EMOJI', 0, 2, custom_emoji_id=5368324170671202286)]),
+        ("👍👍", [entity('CUSTOM_EMOJI', 0, 2, custom_emoji_id=1), entity('CUSTOM_EMOJI', 2, 2, custom_emoji_id=2),
+                  entity('SPOILER', 0, 4)]),
+        # Links, code blocks and quotes
+        ("see https://example.com #tag", [entity('URL', 4, 19), entity('HASHTAG', 24, 4)]),
+        ("click here", [entity('TEXT_LINK', 6, 4, url="https://example.com/?a=1&b=2")]),
+        ("print(1)\nprint(2)", [entity('PRE', 0, 17, language="python"), entity('CODE', 0, 8)]),
+        ("quote\nline two", [entity('BLOCKQUOTE', 0, 14), entity('SPOILER', 6, 8), entity('STRIKETHROUGH', 6, 4)]),
+        # Text isn't escaped
+        ("<a & b>", [entity('BOLD', 1, 5)]),
+    ]
+
+    rng = random.Random(0)
+    chars = list("abcdefghij klmnop\n") + ["😀", "👍", "ü", "中"]
+    for _ in range(100):
+        text = "".join(rng.choice(chars) for _ in range(rng.randint(1, 80)))
+        # UTF-16 offset of each character boundary
+        bounds = [0]
+        for c in text:
+            bounds.append(bounds[-1] + len(c.encode('utf-16-le')) // 2)
+        entities = []
+        for _ in range(rng.randint(0, 8)):
+            a, b = sorted(rng.sample(bounds, 2)) if len(bounds) > 1 else (0, 0)
+            ty = rng.choice(TYPES)
+            entities.append(MessageEntity(
+                type=ty, offset=a, length=b - a,
+                url="https://example.com" if ty == MessageEntityType.TEXT_LINK else None,
+                custom_emoji_id=rng.randrange(1 << 60) if ty == MessageEntityType.CUSTOM_EMOJI else None))
+        cases.append((text, entities))
+    return cases
+
+
+def write_golden():
+    cases = [{'text': t, 'entities': [entity_dict(e) for e in es], 'html': legacy_convert_text(t, es)}
+             for t, es in golden_cases()]
+    # One case per line, so that changes to the corpus are readable in diffs
+    GOLDEN.write_text("[\n" + ",\n".join(json.dumps(c, ensure_ascii=False) for c in cases) + "\n]\n")
+    print(f"Saved {len(cases)} cases to {GOLDEN}")
+
+
+def check_golden():
+    cases = json.loads(GOLDEN.read_text())
+    failed = 0
+    for c in cases:
+        out = convert_text(c['text'], [entity(**e) for e in c['entities']])
+        if out != c['html']:
+            failed += 1
+            print(f"Mismatch for {c['text']!r} {c['entities']}:\n  expected {c['html']!r}\n  got      {out!r}")
+    assert not failed, f"{failed} of {len(cases)} golden cases don't match"
+    print(f"All {len(cases)} golden cases match")
+
+
+def gen_post(length: int, n_entities: int) -> tuple[str, list[MessageEntity]]:
+    text = "".join(random.choice("abcdefghij klmnop\n") for _ in range(length))
+    entities = []
+    for _ in range(n_entities):
+        start = random.randrange(length)
+        entities.append(MessageEntity(type=random.choice(TYPES), offset=start,
+                                      length=random.randint(1, min(50, length - start)),
+                                      url="https://example.com", custom_emoji_id=random.randrange(1 << 60)))
+    return text, sorted(entities, key=lambda e: e.offset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check convert_text against the golden corpus and time it")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="Regenerate the golden corpus from the previous implementation")
+    args = parser.parse_args()
+    if args.update_golden:
+        write_golden()
+    check_golden()
+
+    random.seed(0)
+    for length, n in [(200, 5), (4096, 100), (20000, 500), (100000, 2000)]:
+        posts = [gen_post(length, n) for _ in range(10)]
+        assert all(convert_text(*p) == legacy_convert_text(*p) for p in posts)
+
+        for name, fn in [("legacy", legacy_convert_text), ("single-pass", convert_text)]:
+            t = timeit.timeit(lambda: [fn(*p) for p in posts], number=5) / 5 / len(posts)
+            print(f"{length:>7} chars {n:>5} entities | {name:<12} {t * 1000:8.3f} ms/post")
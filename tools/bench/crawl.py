@@ -0,0 +1,40 @@
+# Benchmark history crawling with different numbers of get_messages requests in flight, against a mock client
+# Usage: python -m tools.bench.crawl [-n 20000] [--latency 0.4] [--rate 5]
+import argparse
+import asyncio
+import time
+
+from tgc.pyro.history import fetch_windows, latest_message_id
+from tgc.pyro.ratelimit import limiter
+from tools.bench.mock_client import MockClient, NetworkSpec
+from tools.bench.synthetic import ChannelSpec
+
+
+async def crawl(client: MockClient, depth: int) -> int:
+    end_id = await latest_message_id(client, 0)
+    n = 0
+    async for _, window in fetch_windows(client, 0, 1, depth, end_id):
+        n += len(window)
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare crawl throughput for different crawl depths")
+    parser.add_argument("-n", type=int, default=20000, help="Number of message IDs in the mock chat")
+    parser.add_argument("--latency", type=float, default=0.4, help="Seconds per get_messages request")
+    parser.add_argument("--rate", type=float, default=5, help="Allowed get_messages requests per second")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--bot", action="store_true", help="Crawl without knowing the latest message ID")
+    args = parser.parse_args()
+
+    base = None
+    for depth in args.depths:
+        limiter.configure({'messages': (args.rate, args.rate * 2)})
+        client = MockClient(ChannelSpec(n_messages=args.n), NetworkSpec(latency=args.latency), is_bot=args.bot)
+        start = time.perf_counter()
+        n = asyncio.run(crawl(client, depth))
+        t = time.perf_counter() - start
+        base = base or t
+        print(f"depth {depth:>2} | {n} msgs in {t:6.2f}s ({n / t:7.0f} msgs/s, "
+              f"{client.requests['get_messages']} requests) | "
+              f"speedup {base / t:.2f}x")
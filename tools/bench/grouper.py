@@ -0,0 +1,59 @@
+# Scaling benchmark for tgc.pyro.grouper.group_msgs on synthetic processed messages
+# Usage: python -m tools.bench.grouper [--album-ratio 0.3] [--max 1000000]
+import argparse
+import random
+import time
+
+from tgc.pyro.grouper import group_msgs, merge_tail, tail_start
+
+
+def gen_msgs(n: int, album_ratio: float, reply_ratio: float = 0.05) -> list[dict]:
+    """
+    Generate processed (not yet grouped) message records, where album_ratio of the messages are in albums of 2-10
+    """
+    msgs = []
+    gid = 0
+    i = 1
+    while i <= n:
+        if random.random() < album_ratio:
+            gid += 1
+            for j in range(min(random.randint(2, 10), n - i + 1)):
+                m = {'id': i, 'date': '2023-01-01T00:00:00', 'media_group_id': gid, 'image': {'url': f'media/{i}.jpg'}}
+                if j == 0:
+                    m['text'] = f'Album {gid}'
+                msgs.append(m)
+                i += 1
+        else:
+            m = {'id': i, 'date': '2023-01-01T00:00:00', 'text': f'Post {i}'}
+            if i > 1 and random.random() < reply_ratio:
+                m['reply_id'] = random.randint(1, i - 1)
+            msgs.append(m)
+            i += 1
+    return msgs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure group_msgs scaling")
+    parser.add_argument("--album-ratio", type=float, default=0.3)
+    parser.add_argument("--max", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    n = 1000
+    while n <= args.max:
+        random.seed(n)
+        msgs = gen_msgs(n, args.album_ratio)
+        start = time.perf_counter()
+        posts = group_msgs(msgs)
+        full = time.perf_counter() - start
+
+        # Incremental: re-group only the last 200 messages (plus the albums they cut into)
+        random.seed(n)
+        fresh = gen_msgs(n, args.album_ratio)
+        start = time.perf_counter()
+        tail_id = tail_start(posts, n - 199)
+        merge_tail(posts, [m for m in fresh if m['id'] >= tail_id], tail_id)
+        inc = time.perf_counter() - start
+
+        print(f"{n:>9} msgs | full {full * 1000:9.1f} ms ({full / n * 1e6:.2f} us/msg) | "
+              f"tail of 200 {inc * 1000:7.1f} ms")
+        n *= 10
@@ -0,0 +1,192 @@
+# Offline benchmark suite: crawls a synthetic channel through a mock client, converts a synthetic tdesktop export,
+# and times each stage of the pipeline. The report is written as JSON, so that versions can be compared.
+# Usage: python -m tools.bench.harness [-n 1000] [--latency 0.1] [--out report.json] [--compare old_report.json]
+import argparse
+import asyncio
+import importlib.util
+import json
+import platform
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable
+
+import tgc
+from tgc.convert_export import ExportConverter
+from tgc.output import write_posts, load_posts
+from tgc.pyro import crawl
+from tgc.pyro.config import Config
+from tgc.pyro.download_media import is_complete
+from tgc.pyro.grouper import group_msgs
+from tgc.pyro.ratelimit import limiter, DEFAULT_RATES
+from tgc.pyro.store import MessageStore
+from tgc.rss.posts_to_feed import posts_to_feed, FeedMeta
+from tools.bench.mock_client import MockClient, NetworkSpec
+from tools.bench.synthetic import ChannelSpec, write_export
+
+FEED = FeedMeta(title="Bench", link="https://example.com", description="Bench", language="en",
+                image_url="https://example.com/icon.png")
+
+
+class Report:
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+
+    def stage(self, name: str, items: int | Callable[[], int], fn, *args):
+        """
+        Time one stage
+
+        :param items: Number of items the stage processes, or a function that counts them after the stage ran
+        :param fn: Stage function
+        :return: Result of the stage
+        """
+        start = time.perf_counter()
+        result = fn(*args)
+        t = time.perf_counter() - start
+        items = items() if callable(items) else items
+        self.stages[name] = {'seconds': round(t, 4), 'items': items, 'items_per_second': round(items / t, 1)}
+        return result
+
+
+def bench_crawl(report: Report, spec: ChannelSpec, net: NetworkSpec, root: Path, rate_scale: float) -> MockClient:
+    """
+    Crawl the synthetic channel through the real crawler (full, incremental and offline rebuild)
+    """
+    client = MockClient(spec, net)
+    export = {'chat_id': 1, 'path': str(root / "crawl"), 'message_store': str(root / "store"), 'rss': asdict(FEED)}
+    crawl.app = client
+    crawl.cfg = Config(api_id=0, api_hash="", bot_token="", exports=[export])
+    crawl.executor = ThreadPoolExecutor(2)
+    limiter.configure({k: (r * rate_scale, b * rate_scale) for k, (r, b) in DEFAULT_RATES.items()})
+
+    # Crawls count the message IDs they fetched, the incremental one only fetches the re-checked tail
+    def fetched(before: int) -> Callable[[], int]:
+        return lambda: client.fetched_ids - before
+
+    assert report.stage('crawl_full', fetched(0), lambda: asyncio.run(crawl.process_export(export, True)))
+    assert report.stage('crawl_incremental', fetched(client.fetched_ids),
+                        lambda: asyncio.run(crawl.process_export(export, False)))
+    assert report.stage('rebuild', len(client.plan), crawl.rebuild_export, export)
+    print(f"Checked the sizes of {check_downloads(client, root / 'crawl')} downloaded files")
+    crawl.executor.shutdown()
+    return client
+
+
+def check_downloads(client: MockClient, path: Path) -> int:
+    """
+    Check that every downloaded file has its expected size, so that truncated downloads can't go unnoticed
+
+    :param path: Export path
+    :return: Number of files checked
+    """
+    expected = dict(client.expected)
+    # Large files are streamed into place by the crawler, their sizes come from the post records
+    for p in load_posts(path):
+        for f in (p.get('files') or []) + (p.get('images') or []):
+            # Converted stickers keep the size of the original file
+            if f.get('url') and f.get('size') and not f['url'].endswith(".apng"):
+                expected[str((path / f['url']).absolute())] = f['size']
+
+    bad = [f"{fp} ({Path(fp).stat().st_size if Path(fp).is_file() else 'missing'} != {size})"
+           for fp, size in expected.items() if not is_complete(Path(fp), size)]
+    assert not bad, f"{len(bad)} downloaded files don't match their size: {', '.join(bad[:5])}"
+    return len(expected)
+
+
+def bench_stages(report: Report, client: MockClient, root: Path):
+    """
+    Time the CPU-bound stages on their own, on the messages of the synthetic channel
+    """
+    msgs = [client.message(p.id) for p in client.plan if p and p.text]
+    report.stage('convert_text', len(msgs), lambda: [crawl.effective_text(m) for m in msgs])
+
+    store = MessageStore(root / "store")
+    records = [r for _, r in store.items()]
+    store.close()
+    posts = report.stage('group_msgs', len(records), group_msgs, records)
+
+    out = root / "output"
+    report.stage('write_posts', len(posts), write_posts, out, posts)
+    report.stage('write_posts_paged', len(posts), write_posts, out / "paged", posts, 100)
+    posts = load_posts(out)
+    report.stage('posts_to_feed', len(posts), posts_to_feed, out, FEED, posts)
+    report.stage('posts_to_feed_cached', len(posts), posts_to_feed, out, FEED, posts)
+
+
+def bench_export(report: Report, spec: ChannelSpec, root: Path):
+    """
+    Convert a synthetic tdesktop export with tgce, in memory and streaming
+    """
+    src = root / "export"
+    n = write_export(spec, src)
+    report.stage('tgce', n, lambda: ExportConverter(shutil.copytree(src, root / "tgce"), 2).convert())
+    if importlib.util.find_spec('ijson'):
+        report.stage('tgce_stream', n, lambda: ExportConverter(shutil.copytree(src, root / "tgce_stream"), 2)
+                     .convert(stream=True))
+
+
+def compare(report: dict, old: dict):
+    print(f"{'stage':<22} {'old':>10} {'new':>10} {'change':>8}")
+    for name, s in report['stages'].items():
+        if name in old.get('stages', {}):
+            o = old['stages'][name]['seconds']
+            print(f"{name:<22} {o:>9.3f}s {s['seconds']:>9.3f}s {(s['seconds'] / o - 1) * 100:>+7.1f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark every stage offline with a mock client")
+    parser.add_argument("-n", type=int, default=1000, help="Number of message IDs in the synthetic channel")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--text-length", type=int, default=300, help="Mean text length")
+    parser.add_argument("--entity-density", type=float, default=2, help="Entities per 100 characters")
+    parser.add_argument("--album-ratio", type=float, default=0.1)
+    parser.add_argument("--media-ratio", type=float, default=0.4)
+    parser.add_argument("--sticker-ratio", type=float, default=0.1)
+    parser.add_argument("--document-ratio", type=float, default=0.1)
+    parser.add_argument("--media-size-kb", type=int, default=200, help="Mean media size")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds per request")
+    parser.add_argument("--bandwidth", type=float, default=20, help="Download bandwidth in MB/s")
+    parser.add_argument("--flood-ratio", type=float, default=0, help="Probability of a FloodWait on each request")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="Duration of each FloodWait")
+    parser.add_argument("--drop-ratio", type=float, default=0, help="Probability of a download request failing")
+    parser.add_argument("--rate-scale", type=float, default=1, help="Multiply the default rate limits")
+    parser.add_argument("--out", default="bench-report.json", help="Report path")
+    parser.add_argument("--compare", help="Previous report to compare with")
+    args = parser.parse_args()
+
+    spec = ChannelSpec(n_messages=args.n, seed=args.seed, text_length=args.text_length,
+                       entity_density=args.entity_density, album_ratio=args.album_ratio, media_ratio=args.media_ratio,
+                       sticker_ratio=args.sticker_ratio, document_ratio=args.document_ratio,
+                       media_size_kb=args.media_size_kb)
+    net = NetworkSpec(latency=args.latency, bandwidth=args.bandwidth, flood_ratio=args.flood_ratio,
+                      flood_seconds=args.flood_seconds, drop_ratio=args.drop_ratio, seed=args.seed)
+
+    report = Report()
+    with TemporaryDirectory() as tmp:
+        client = bench_crawl(report, spec, net, Path(tmp), args.rate_scale)
+        bench_stages(report, client, Path(tmp))
+        bench_export(report, spec, Path(tmp))
+
+    result = {
+        'version': tgc.__version__,
+        'python': platform.python_version(),
+        'channel': asdict(spec),
+        'network': asdict(net),
+        'rate_scale': args.rate_scale,
+        'stages': report.stages,
+        'requests': dict(client.requests),
+        'flood_waits': client.flood_waits,
+        'download_back_offs': limiter.buckets['download'].back_offs,
+        'downloaded_mb': round(client.downloaded / 1e6, 1),
+    }
+    Path(args.out).write_text(json.dumps(result, indent=2))
+
+    print()
+    for name, s in report.stages.items():
+        print(f"{name:<22} {s['seconds']:>9.3f}s {s['items']:>8} items {s['items_per_second']:>10.1f} items/s")
+    print(f"Report saved to {args.out}")
+    if args.compare:
+        compare(result, json.loads(Path(args.compare).read_text()))
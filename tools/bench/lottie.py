@@ -0,0 +1,32 @@
+# Benchmark TGS -> APNG conversion: one puppeteer-lottie process per sticker vs one batch renderer session
+# Usage: python -m tools.bench.lottie <directory with .tgs files> [-n max stickers]
+import argparse
+import shutil
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from tgc.convert_media_types import tgs_to_apng, tgs_to_apng_batch
+
+
+def copy_stickers(files: list[Path], into: Path) -> list[Path]:
+    return [Path(shutil.copy(f, into / f.name)) for f in files]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare stickers/minute of per-file and batch lottie rendering")
+    parser.add_argument("dir", help="Directory containing .tgs stickers")
+    parser.add_argument("-n", type=int, default=20, help="Max number of stickers")
+    args = parser.parse_args()
+
+    files = sorted(Path(args.dir).glob("*.tgs"))[:args.n]
+    assert files, f"No .tgs files found in {args.dir}"
+
+    for name, convert in [("per-file", lambda fs: [tgs_to_apng(f) for f in fs]), ("batch", tgs_to_apng_batch)]:
+        with TemporaryDirectory() as tmp:
+            stickers = copy_stickers(files, Path(tmp))
+            start = time.perf_counter()
+            outs = convert(stickers)
+            t = time.perf_counter() - start
+            ok = sum(o.suffix == '.apng' for o in outs)
+            print(f"{name:<9} {ok}/{len(files)} converted in {t:.1f}s | {len(files) / t * 60:.1f} stickers/minute")
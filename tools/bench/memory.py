@@ -0,0 +1,100 @@
+# Memory ceiling of a crawl: runs the real process_export against the mock client, once with the streaming pipeline
+# and once with every raw message collected before processing (the previous behaviour), and reports the peak memory
+# and the most raw pyrogram messages alive at the same time.
+# Usage: python -m tools.bench.memory [-n 10000] [--ceiling-mb 64] [--max-alive 2000]
+import argparse
+import asyncio
+import sys
+import time
+import tracemalloc
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from tgc.pyro import crawl
+from tgc.pyro.config import Config
+from tgc.pyro.ratelimit import limiter
+from tgc.pyro.scheduler import gather_bounded, stream_bounded
+from tools.bench.mock_client import MockClient, NetworkSpec
+from tools.bench.synthetic import ChannelSpec
+
+
+async def collect_bounded(fn, source, limit: int, buffer: int) -> list:
+    """
+    Drop-in for stream_bounded that reads every item before processing them
+    """
+    return await gather_bounded(fn, [it async for it in source], limit)
+
+
+class CountingClient(MockClient):
+    """
+    Mock client that tracks how many of the messages it served are still alive
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.alive = 0
+        self.max_alive = 0
+
+    def released(self):
+        self.alive -= 1
+
+    async def get_messages(self, chat_id: int, message_ids: range) -> list:
+        msgs = await super().get_messages(chat_id, message_ids)
+        for m in msgs:
+            self.alive += 1
+            weakref.finalize(m, self.released)
+        self.max_alive = max(self.max_alive, self.alive)
+        return msgs
+
+
+def measure(spec: ChannelSpec, root: Path, stream: bool) -> tuple[float, int, float]:
+    """
+    Crawl the synthetic channel once
+
+    :return: Peak memory in MB, most raw messages alive at the same time, seconds
+    """
+    client = CountingClient(spec, NetworkSpec(latency=0, bandwidth=1e4))
+    export = {'chat_id': 1, 'path': str(root / "export"), 'message_store': str(root / "store")}
+    crawl.app = client
+    crawl.cfg = Config(api_id=0, api_hash="", bot_token="", exports=[export])
+    crawl.executor = ThreadPoolExecutor(2)
+    crawl.stream_bounded = stream_bounded if stream else collect_bounded
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    assert asyncio.run(crawl.process_export(export, True))
+    t = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    crawl.executor.shutdown()
+    return peak / 1e6, client.max_alive, t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure peak memory of a crawl, collecting vs streaming messages")
+    parser.add_argument("-n", type=int, default=10_000, help="Number of message IDs in the synthetic channel")
+    parser.add_argument("--ceiling-mb", type=float, default=None, help="Fail if streaming peaks above this")
+    parser.add_argument("--max-alive", type=int, default=None,
+                        help="Fail if streaming keeps more raw messages alive at the same time")
+    args = parser.parse_args()
+
+    # Tiny media files, the crawl itself is what's measured
+    spec = ChannelSpec(n_messages=args.n, media_size_kb=1)
+    limiter.configure({'messages': (1e6, 1e6), 'download': (1e6, 1e6), 'other': (1e6, 1e6)})
+
+    results = []
+    for name, stream in [('collect', False), ('stream', True)]:
+        with TemporaryDirectory() as tmp:
+            peak, alive, t = measure(spec, Path(tmp), stream)
+        results.append(f"{name:>8} | {args.n} msgs | peak {peak:8.1f} MB | max {alive:>6} raw messages alive | "
+                       f"{t:.2f}s")
+
+    print()
+    print("\n".join(results))
+    if args.ceiling_mb and peak > args.ceiling_mb:
+        print(f"Streaming peak {peak:.1f} MB is above the ceiling of {args.ceiling_mb} MB")
+        sys.exit(1)
+    if args.max_alive and alive > args.max_alive:
+        print(f"Streaming kept {alive} raw messages alive, more than {args.max_alive}")
+        sys.exit(1)
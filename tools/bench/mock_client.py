@@ -0,0 +1,159 @@
+# Offline stand-in for the parts of pyrogram.Client used by the crawler, for benchmarks
+import asyncio
+import os
+import random
+from collections import Counter
+from dataclasses import dataclass
+from io import StringIO
+from mimetypes import MimeTypes
+from pathlib import Path
+from typing import AsyncIterator
+
+from pyrogram import enums, types
+from pyrogram.errors import FloodWait, BotMethodInvalid
+from pyrogram.file_id import FileType
+from pyrogram.mime_types import mime_types
+
+from tgc.pyro.download_media import has_media, CHUNK_SIZE
+from tools.bench.synthetic import ChannelSpec, plan_channel, build_message, file_ids, TGS
+
+# Pyrogram's get_file sleeps through flood waits up to 30 seconds, whatever the client's sleep threshold is
+GET_FILE_SLEEP_THRESHOLD = 30
+
+
+@dataclass
+class NetworkSpec:
+    """
+    Simulated network: request latency, download bandwidth and flood waits
+    """
+    latency: float = 0.4
+    # Download bandwidth in MB/s
+    bandwidth: float = 20
+    # Probability of a request failing with a FloodWait, and its duration in seconds
+    flood_ratio: float = 0
+    flood_seconds: int = 1
+    # Probability of a download request failing with a network error
+    drop_ratio: float = 0
+    seed: int = 0
+
+
+class MockClient:
+    """
+    Fake client serving a synthetic channel (see ChannelSpec). Messages are built when they are requested, downloads
+    write zero-filled files of the media size (animated stickers get a valid .tgs).
+
+    Errors behave like pyrogram's: flood waits up to sleep_threshold seconds are slept through and longer ones are
+    raised, while download errors are swallowed (handle_download returns the path of the truncated file, and
+    stream_media ends early).
+    """
+    mimetypes = MimeTypes()
+    mimetypes.readfp(StringIO(mime_types))
+
+    def __init__(self, channel: ChannelSpec, network: NetworkSpec = NetworkSpec(), is_bot: bool = False,
+                 sleep_threshold: int = 0):
+        self.channel = channel
+        self.network = network
+        self.is_bot = is_bot
+        self.sleep_threshold = sleep_threshold
+        self.plan = plan_channel(channel)
+        self.rng = random.Random(network.seed)
+        self.requests: Counter[str] = Counter()
+        self.flood_waits = 0
+        self.downloaded = 0
+        # Number of message IDs requested with get_messages
+        self.fetched_ids = 0
+        # Expected size of every file written by handle_download, by absolute path
+        self.expected: dict[str, int] = {}
+
+    async def request(self, kind: str, seconds: float = 0, sleep_threshold: int | None = None):
+        """
+        Simulate a request that takes the network latency plus `seconds`
+
+        :param sleep_threshold: Flood waits up to this many seconds are slept through and the request is retried
+            (defaults to the client's sleep_threshold)
+        """
+        self.requests[kind] += 1
+        await asyncio.sleep(self.network.latency + seconds)
+        if self.rng.random() < self.network.flood_ratio:
+            self.flood_waits += 1
+            threshold = self.sleep_threshold if sleep_threshold is None else sleep_threshold
+            if self.network.flood_seconds > threshold:
+                raise FloodWait(value=self.network.flood_seconds)
+            await asyncio.sleep(self.network.flood_seconds)
+            await self.request(kind, seconds, sleep_threshold)
+
+    async def download_request(self, size: int) -> bool:
+        """
+        Simulate a GetFile request, with its errors swallowed like pyrogram's get_file does
+
+        :return: Whether it succeeded
+        """
+        try:
+            await self.request('download', size / (self.network.bandwidth * 1e6), GET_FILE_SLEEP_THRESHOLD)
+        except FloodWait:
+            return False
+        if self.rng.random() < self.network.drop_ratio:
+            self.requests['dropped'] += 1
+            return False
+        return True
+
+    def message(self, mid: int) -> types.Message:
+        p = self.plan[mid - 1] if 0 < mid <= len(self.plan) else None
+        return build_message(self.channel, p, mid)
+
+    def guess_extension(self, mime_type: str) -> str | None:
+        return self.mimetypes.guess_extension(mime_type)
+
+    async def get_me(self) -> types.User:
+        await self.request('get_me')
+        return types.User(id=1, is_bot=self.is_bot, first_name="Bench")
+
+    async def get_chat(self, chat_id: int) -> types.Chat:
+        await self.request('get_chat')
+        return types.Chat(id=chat_id, type=enums.ChatType.CHANNEL, title="Bench")
+
+    async def get_chat_history(self, chat_id: int, limit: int = 0) -> AsyncIterator[types.Message]:
+        if self.is_bot:
+            raise BotMethodInvalid()
+        await self.request('get_chat_history')
+        newest = (p.id for p in reversed(self.plan) if p)
+        for _, mid in zip(range(limit or len(self.plan)), newest):
+            yield self.message(mid)
+
+    async def get_messages(self, chat_id: int, message_ids: range) -> list[types.Message]:
+        await self.request('get_messages')
+        self.fetched_ids += len(message_ids)
+        return [self.message(i) for i in message_ids]
+
+    async def get_custom_emoji_stickers(self, ids: list[int]) -> list[types.Sticker]:
+        await self.request('get_custom_emoji_stickers')
+        out = []
+        for i in ids:
+            fid, uid = file_ids(FileType.STICKER, i % 1_000_000)
+            out.append(types.Sticker(file_id=fid, file_unique_id=uid, width=100, height=100, is_animated=False,
+                                     is_video=False, mime_type="image/webp", file_size=4096))
+        return out
+
+    async def handle_download(self, packet: tuple) -> str:
+        file_id, directory, file_name, in_memory, file_size, progress, progress_args = packet
+        size = file_size or 16384
+        # Pyrogram returns absolute paths
+        p = Path(os.path.abspath(os.path.join(directory, file_name)))
+        self.expected[str(p)] = size
+        content = TGS if p.suffix == ".tgs" else bytes(size)
+
+        # A failed get_file ends the stream after the chunks received so far, and the truncated file is kept
+        if not await self.download_request(size):
+            content = content[:int(size * self.rng.random()) // CHUNK_SIZE * CHUNK_SIZE]
+        p.write_bytes(content)
+        self.downloaded += len(content)
+        return str(p)
+
+    async def stream_media(self, message, limit: int = 0, offset: int = 0) -> AsyncIterator[bytes]:
+        size = getattr(has_media(message), 'file_size', 0)
+        for start in range(offset * CHUNK_SIZE, size, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, size - start)
+            if not await self.download_request(n):
+                return
+            self.downloaded += n
+            yield bytes(n)
@@ -0,0 +1,306 @@
+# Synthetic channels for the offline benchmarks: pyrogram messages (served by MockClient) and tdesktop exports
+import gzip
+import json
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import NamedTuple
+
+from pyrogram import enums, types
+from pyrogram.file_id import FileId, FileType, FileUniqueId, FileUniqueType, ThumbnailSource
+from pyrogram.types.messages_and_media.message import Str
+
+# Entity types, with their names in tdesktop exports
+ENTITY_TYPES: dict[enums.MessageEntityType, str] = {
+    enums.MessageEntityType.BOLD: "bold",
+    enums.MessageEntityType.ITALIC: "italic",
+    enums.MessageEntityType.UNDERLINE: "underline",
+    enums.MessageEntityType.STRIKETHROUGH: "strikethrough",
+    enums.MessageEntityType.CODE: "code",
+    enums.MessageEntityType.SPOILER: "spoiler",
+    enums.MessageEntityType.URL: "link",
+    enums.MessageEntityType.TEXT_LINK: "text_link",
+}
+# Animated sticker: a gzipped lottie animation with no layers
+TGS = gzip.compress(json.dumps({"v": "5.5.2", "fr": 30, "ip": 0, "op": 30, "w": 512, "h": 512, "layers": []}).encode())
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt".split()
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclass
+class ChannelSpec:
+    """
+    Shape of a synthetic channel. Sizes are log-normally distributed around their means.
+    """
+    n_messages: int = 2000
+    seed: int = 0
+    # Ratio of message IDs that are deleted
+    deleted_ratio: float = 0.05
+    # Mean text length in characters, and entities per 100 characters
+    text_length: int = 300
+    entity_density: float = 2
+    # Ratio of entities that are custom emojis, and the number of distinct custom emojis
+    custom_emoji_ratio: float = 0.1
+    custom_emojis: int = 20
+    # Ratio of messages that start an album (of 2-10 photos), and of the other messages that have a photo/video
+    album_ratio: float = 0.1
+    media_ratio: float = 0.4
+    video_ratio: float = 0.3
+    # Ratio of the messages without a photo/video that are stickers (a share of them animated), documents or audio
+    sticker_ratio: float = 0.1
+    animated_sticker_ratio: float = 0.5
+    document_ratio: float = 0.1
+    audio_ratio: float = 0.05
+    # Mean media size in KB
+    media_size_kb: int = 200
+    reply_ratio: float = 0.05
+
+
+class Entity(NamedTuple):
+    type: enums.MessageEntityType
+    offset: int
+    length: int
+
+
+class Planned(NamedTuple):
+    """
+    A message of the synthetic channel, from which both pyrogram messages and export entries are built
+    """
+    id: int
+    date: datetime
+    text: str | None
+    entities: list[Entity]
+    media: str | None
+    media_size: int
+    group_id: int | None
+    reply_id: int | None
+
+
+def lognormal(rng: random.Random, mean: float) -> int:
+    # Log-normal with sigma 1 has its mean at exp(mu + 1/2)
+    return max(1, int(rng.lognormvariate(math.log(max(mean, 1)) - 0.5, 1)))
+
+
+def gen_text(rng: random.Random, spec: ChannelSpec) -> tuple[str, list[Entity]]:
+    n = lognormal(rng, spec.text_length)
+    words = []
+    while sum(map(len, words)) + len(words) < n:
+        words.append(rng.choice(WORDS))
+    text = " ".join(words)
+
+    # Non-overlapping entities over whole words, so that they can be represented in tdesktop exports too
+    entities = []
+    n_entities = min(len(words), round(len(text) / 100 * spec.entity_density))
+    picked = sorted(rng.sample(range(len(words)), n_entities))
+    offsets = [0]
+    for w in words:
+        offsets.append(offsets[-1] + len(w) + 1)
+    for i in picked:
+        if rng.random() < spec.custom_emoji_ratio:
+            ty = enums.MessageEntityType.CUSTOM_EMOJI
+        else:
+            ty = rng.choice(list(ENTITY_TYPES))
+        entities.append(Entity(ty, offsets[i], len(words[i])))
+    return text, entities
+
+
+def plan_channel(spec: ChannelSpec) -> list[Planned | None]:
+    """
+    Plan the messages of a synthetic channel
+
+    :return: Planned message for each ID starting from 1, or None for deleted IDs
+    """
+    rng = random.Random(spec.seed)
+    plan: list[Planned | None] = []
+    gid = 0
+    while len(plan) < spec.n_messages:
+        mid = len(plan) + 1
+        date = START + timedelta(minutes=mid)
+        if rng.random() < spec.deleted_ratio:
+            plan.append(None)
+            continue
+
+        reply_id = rng.randint(1, mid - 1) if mid > 1 and rng.random() < spec.reply_ratio else None
+        text, entities = gen_text(rng, spec)
+
+        # Albums of photos sent at the same time, with the text on the first photo
+        if rng.random() < spec.album_ratio:
+            gid += 1
+            for j in range(min(rng.randint(2, 10), spec.n_messages - len(plan))):
+                plan.append(Planned(len(plan) + 1, date, text if j == 0 else None, entities if j == 0 else [],
+                                    'photo', lognormal(rng, spec.media_size_kb) * 1024, gid, reply_id))
+            continue
+
+        media = None
+        if rng.random() < spec.media_ratio:
+            media = 'video' if rng.random() < spec.video_ratio else 'photo'
+        else:
+            r = rng.random()
+            if r < spec.sticker_ratio:
+                media = 'animated_sticker' if rng.random() < spec.animated_sticker_ratio else 'sticker'
+            elif r < spec.sticker_ratio + spec.document_ratio:
+                media = 'document'
+            elif r < spec.sticker_ratio + spec.document_ratio + spec.audio_ratio:
+                media = 'audio'
+
+        size = lognormal(rng, spec.media_size_kb) * 1024 if media else 0
+        if media == 'animated_sticker':
+            size = len(TGS)
+        elif media == 'sticker':
+            size = lognormal(rng, 30) * 1024
+        # Stickers don't have captions
+        if media in ('sticker', 'animated_sticker'):
+            text, entities = None, []
+        plan.append(Planned(mid, date, text, entities, media, size, None, reply_id))
+    return plan
+
+
+def emoji_id(spec: ChannelSpec, e: Entity) -> int:
+    return 5000_000_000_000_000_000 + e.offset % spec.custom_emojis
+
+
+def file_ids(file_type: FileType, media_id: int) -> tuple[str, str]:
+    """
+    Valid (decodable) file id and file unique id of a synthetic file
+    """
+    fid = FileId(file_type=file_type, dc_id=2, media_id=media_id, access_hash=media_id, file_reference=b"",
+                 thumbnail_source=ThumbnailSource.THUMBNAIL, thumbnail_file_type=file_type, thumbnail_size="m",
+                 volume_id=0, local_id=0)
+    return fid.encode(), FileUniqueId(file_unique_type=FileUniqueType.DOCUMENT, media_id=media_id).encode()
+
+
+def thumbnails(media_id: int) -> list[types.Thumbnail]:
+    out = []
+    for i, (w, size) in enumerate([(90, 2000), (320, 15000)]):
+        # Offset, so that thumbnails don't share unique ids with the files of other messages
+        fid, uid = file_ids(FileType.THUMBNAIL, 1_000_000_000 + media_id * 10 + i)
+        out.append(types.Thumbnail(file_id=fid, file_unique_id=uid, width=w, height=w * 9 // 16, file_size=size))
+    return out
+
+
+def build_message(spec: ChannelSpec, p: Planned | None, mid: int) -> types.Message:
+    """
+    Build the pyrogram message of a planned message
+    """
+    if p is None:
+        return types.Message(id=mid, empty=True)
+
+    def entity(e: Entity) -> types.MessageEntity:
+        eid = emoji_id(spec, e) if e.type == enums.MessageEntityType.CUSTOM_EMOJI else None
+        return types.MessageEntity(type=e.type, offset=e.offset, length=e.length, url="https://example.com",
+                                   custom_emoji_id=eid)
+
+    entities = [entity(e) for e in p.entities]
+    text = Str(p.text).init(entities) if p.text else None
+    kw = {}
+    if p.media == 'photo':
+        fid, uid = file_ids(FileType.PHOTO, p.id)
+        kw = dict(media=enums.MessageMediaType.PHOTO, caption=text, caption_entities=entities or None,
+                  photo=types.Photo(file_id=fid, file_unique_id=uid, width=1280, height=720, file_size=p.media_size,
+                                    date=p.date, thumbs=thumbnails(p.id)))
+    elif p.media == 'video':
+        fid, uid = file_ids(FileType.VIDEO, p.id)
+        kw = dict(media=enums.MessageMediaType.VIDEO, caption=text, caption_entities=entities or None,
+                  video=types.Video(file_id=fid, file_unique_id=uid, width=1280, height=720, duration=10,
+                                    mime_type="video/mp4", file_size=p.media_size, date=p.date,
+                                    thumbs=thumbnails(p.id)))
+    elif p.media in ('sticker', 'animated_sticker'):
+        fid, uid = file_ids(FileType.STICKER, p.id)
+        animated = p.media == 'animated_sticker'
+        kw = dict(media=enums.MessageMediaType.STICKER,
+                  sticker=types.Sticker(file_id=fid, file_unique_id=uid, width=512, height=512, is_animated=animated,
+                                        is_video=False, emoji="👍", file_size=p.media_size, date=p.date,
+                                        mime_type="application/x-tgsticker" if animated else "image/webp",
+                                        thumbs=thumbnails(p.id)))
+    elif p.media == 'document':
+        fid, uid = file_ids(FileType.DOCUMENT, p.id)
+        kw = dict(media=enums.MessageMediaType.DOCUMENT, caption=text, caption_entities=entities or None,
+                  document=types.Document(file_id=fid, file_unique_id=uid, file_name=f"report_{p.id}.pdf",
+                                          mime_type="application/pdf", file_size=p.media_size, date=p.date))
+    elif p.media == 'audio':
+        fid, uid = file_ids(FileType.AUDIO, p.id)
+        kw = dict(media=enums.MessageMediaType.AUDIO, caption=text, caption_entities=entities or None,
+                  audio=types.Audio(file_id=fid, file_unique_id=uid, duration=180, performer="Bench",
+                                    title=f"Track {p.id}", file_name=f"track_{p.id}.mp3", mime_type="audio/mpeg",
+                                    file_size=p.media_size, date=p.date))
+    elif text:
+        kw = dict(text=text, entities=entities or None)
+
+    return types.Message(id=p.id, date=p.date, views=p.id * 3, forwards=p.id % 7, reply_to_message_id=p.reply_id,
+                         media_group_id=str(p.group_id) if p.group_id else None, **kw)
+
+
+def export_text(spec: ChannelSpec, p: Planned) -> list[str | dict]:
+    """
+    Text of a planned message in the tdesktop export format
+    """
+    out: list[str | dict] = []
+    last = 0
+    for e in p.entities:
+        if e.offset > last:
+            out.append(p.text[last:e.offset])
+        t = p.text[e.offset:e.offset + e.length]
+        if e.type == enums.MessageEntityType.CUSTOM_EMOJI:
+            out.append({"type": "custom_emoji", "text": t, "document_id": f"emoji/{emoji_id(spec, e)}.webp"})
+        elif e.type == enums.MessageEntityType.TEXT_LINK:
+            out.append({"type": "text_link", "text": t, "href": "https://example.com"})
+        else:
+            out.append({"type": ENTITY_TYPES[e.type], "text": t})
+        last = e.offset + e.length
+    if last < len(p.text):
+        out.append(p.text[last:])
+    return out
+
+
+def write_export(spec: ChannelSpec, path: Path, media_bytes: int = 1024) -> int:
+    """
+    Write a synthetic tdesktop export (result.json, with photos/, files/ and stickers/ directories)
+
+    :param media_bytes: Size of each written media file (kept small, tgce only stats them, except for animated
+        stickers which are converted)
+    :return: Number of messages written
+    """
+    for d in ("photos", "files", "stickers"):
+        (path / d).mkdir(parents=True, exist_ok=True)
+    msgs = []
+    for p in plan_channel(spec):
+        if p is None:
+            continue
+        # tdesktop exports don't know media groups, albums are inferred from photos sent within 5 seconds
+        d = {"id": p.id, "type": "message", "date": p.date.strftime("%Y-%m-%dT%H:%M:%S"),
+             "date_unixtime": str(int(p.date.timestamp())), "from": "Bench", "from_id": "channel1",
+             "text": export_text(spec, p) if p.text else ""}
+        if p.reply_id:
+            d["reply_to_message_id"] = p.reply_id
+        if p.media == 'photo':
+            d |= {"photo": f"photos/photo_{p.id}@{p.date:%d-%m-%Y_%H-%M-%S}.jpg", "width": 1280, "height": 720}
+            (path / d["photo"]).write_bytes(bytes(media_bytes))
+        elif p.media == 'video':
+            d |= {"file": f"files/video_{p.id}.mp4", "thumbnail": f"files/video_{p.id}.mp4_thumb.jpg",
+                  "media_type": "video_file", "mime_type": "video/mp4", "duration_seconds": 10,
+                  "width": 1280, "height": 720}
+            (path / d["file"]).write_bytes(bytes(media_bytes))
+            (path / d["thumbnail"]).write_bytes(bytes(media_bytes // 8))
+        elif p.media in ('sticker', 'animated_sticker'):
+            ext = ".tgs" if p.media == 'animated_sticker' else ".webp"
+            d |= {"file": f"stickers/sticker_{p.id}{ext}", "thumbnail": f"stickers/sticker_{p.id}{ext}_thumb.jpg",
+                  "media_type": "sticker", "sticker_emoji": "👍", "width": 512, "height": 512}
+            (path / d["file"]).write_bytes(TGS if ext == ".tgs" else bytes(media_bytes))
+            (path / d["thumbnail"]).write_bytes(bytes(media_bytes // 8))
+        elif p.media == 'document':
+            d |= {"file": f"files/report_{p.id}.pdf", "mime_type": "application/pdf"}
+            (path / d["file"]).write_bytes(bytes(media_bytes))
+        elif p.media == 'audio':
+            # With the album art, which tgce would otherwise extract with ffmpeg
+            d |= {"file": f"files/track_{p.id}.mp3", "thumbnail": f"files/track_{p.id}.mp3_thumb.jpg",
+                  "media_type": "audio_file", "mime_type": "audio/mpeg", "performer": "Bench",
+                  "title": f"Track {p.id}", "duration_seconds": 180}
+            (path / d["file"]).write_bytes(bytes(media_bytes))
+            (path / d["thumbnail"]).write_bytes(bytes(media_bytes // 8))
+        msgs.append(d)
+
+    (path / "result.json").write_text(json.dumps({"name": "Bench", "type": "public_channel", "id": 1,
+                                                   "messages": msgs}, ensure_ascii=False))
+    return len(msgs)